@@ -0,0 +1,156 @@
+"""Country and region of a location by point-in-polygon lookups in Natural Earth boundaries,
+kept next to the code like the coastlines: python admin_polygons.py builds the bundle once"""
+import os
+import argparse
+import numpy as np
+from dataset import ADMIN_LEVELS
+
+BUNDLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'admin_polygons.npz')
+SCALE = '10m'
+# level -> Natural Earth category, feature and the attributes naming a polygon (first one set wins),
+# countries are named as reverse_geocoder's cc and the CSV country column
+LEVELS = {
+    'country': ('cultural', 'admin_0_countries', ('ISO_A2_EH', 'ISO_A2', 'iso_a2')),
+    'region': ('cultural', 'admin_1_states_provinces', ('name', 'NAME')),
+}
+
+_index = None
+_dataset_codes = {}
+
+
+def record_name(attributes, keys):
+    for key in keys:
+        value = attributes.get(key)
+        if value not in (None, '', '-99'):
+            return str(value)
+    return ''
+
+
+def build(path=BUNDLE_FILE, scale=SCALE, source_dir=None):
+    # Polygons are stored as WKB, concatenated with their offsets, so loading needs neither
+    # the shapefiles nor cartopy. As in natural_earth.build, source_dir holds shapefiles copied by hand
+    import shapely
+    import cartopy.io.shapereader as shpreader
+
+    arrays = {}
+    for level, (category, feature, keys) in LEVELS.items():
+        if source_dir is not None:
+            shapefile = os.path.join(source_dir, f"ne_{scale}_{feature}.shp")
+        else:
+            shapefile = shpreader.natural_earth(resolution=scale, category=category, name=feature)
+        records = list(shpreader.Reader(shapefile).records())
+        wkbs = shapely.to_wkb([record.geometry for record in records])
+        arrays[level + '_wkb'] = np.frombuffer(b''.join(wkbs), dtype=np.uint8)
+        arrays[level + '_offsets'] = np.cumsum([0] + [len(wkb) for wkb in wkbs]).astype(np.int64)
+        arrays[level + '_names'] = np.array([record_name(record.attributes, keys) for record in records])
+    np.savez(path, **arrays)
+    return path
+
+
+class PolygonIndex(object):
+    # STR-tree over the polygons' boxes, then one vectorized containment test of the candidates.
+    # The test runs against the polygons, so preparing them pays off (a query with a predicate prepares the points)
+    def __init__(self, geometries, names):
+        import shapely
+        self.geometries = np.asarray(geometries)
+        self.names = np.asarray(names)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def lookup(self, lons, lats):
+        # index of the polygon holding each point, -1 for points outside all of them (e.g. at sea)
+        import shapely
+        x = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        found = np.full(len(x), -1, dtype=np.int64)
+        point_index, polygon_index = self.tree.query(shapely.points(x, y))
+        inside = shapely.contains_xy(self.geometries[polygon_index], x[point_index], y[point_index])
+        found[point_index[inside]] = polygon_index[inside]
+        return found
+
+    def name(self, index):
+        return str(self.names[index]) if index >= 0 else float('nan')
+
+
+def load(path=BUNDLE_FILE):
+    # level -> PolygonIndex, or None when no bundle was built
+    global _index
+    if _index is None:
+        if not os.path.exists(path):
+            return None
+        import shapely
+        index = {}
+        with np.load(path) as data:
+            for level in LEVELS:
+                wkb, offsets = data[level + '_wkb'].tobytes(), data[level + '_offsets']
+                geometries = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+                index[level] = PolygonIndex(geometries, data[level + '_names'])
+        _index = index
+    return _index
+
+
+def get_index():
+    index = load()
+    if index is None:
+        raise FileNotFoundError(f"No admin polygons in {BUNDLE_FILE}, build them with python admin_polygons.py")
+    return index
+
+
+def admin_codes(lons, lats):
+    # (n, 4) polygon indices in the order of ADMIN_LEVELS, -1 where there is no polygon:
+    # city and area are always -1, Natural Earth stops at regions
+    index = get_index()
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    codes = np.full((len(lons), len(ADMIN_LEVELS)), -1, dtype=np.int64)
+    for level, polygons in index.items():
+        codes[:, ADMIN_LEVELS.index(level)] = polygons.lookup(lons, lats)
+    return codes
+
+
+def dataset_codes(dataset):
+    # admin_codes of all the true locations of a dataset, in one batch and once per process
+    # (datasets are themselves loaded once per process, see dataset.load_dataset)
+    codes = _dataset_codes.get(id(dataset))
+    if codes is None:
+        codes = admin_codes(dataset.coordinates[:, 0], dataset.coordinates[:, 1])
+        _dataset_codes[id(dataset)] = codes
+    return codes
+
+
+def admin_names(lons, lats):
+    # {'country': [...], 'region': [...]} names of the polygons, NaN where there is none
+    index = get_index()
+    return {level: [polygons.name(i) for i in polygons.lookup(lons, lats).tolist()] for level, polygons in index.items()}
+
+
+class PolygonTally(object):
+    # Same counts as geocode.AdminTally, but the click is compared with the true location's polygons
+    # (see admin_codes) instead of the CSV names: exact near borders, and a lookup is fast enough to be done in place
+    SCORED_LEVELS = tuple(level for level in ADMIN_LEVELS if level in LEVELS)
+
+    def __init__(self):
+        self.correct = [0, 0, 0, 0]
+        self.valid = [0, 0, 0, 0]
+
+    def add(self, clicked_codes, true_codes):
+        for i in range(4):
+            if true_codes[i] >= 0:
+                self.valid[i] += 1
+                if clicked_codes[i] == true_codes[i]:
+                    self.correct[i] += 1
+
+    def submit(self, lat, lon, true_codes):
+        self.add(admin_codes(lon, lat)[0], true_codes)
+
+    def accuracies(self):
+        return [c / v if v else 0 for c, v in zip(self.correct, self.valid)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the local country and region polygons bundle')
+    parser.add_argument('--output', type=str, required=False, help='Bundle file', default=BUNDLE_FILE)
+    parser.add_argument('--scale', type=str, required=False, help='Natural Earth scale', default=SCALE)
+    parser.add_argument('--source_dir', type=str, required=False, help='Folder with the Natural Earth shapefiles (default: fetched by cartopy)', default=None)
+
+    args = parser.parse_args()
+    print(build(args.output, args.scale, args.source_dir))
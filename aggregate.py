@@ -0,0 +1,226 @@
+"""Per-image and per-player statistics over the game results, updated incrementally"""
+import os
+import json
+import glob
+import sqlite3
+import argparse
+import numpy as np
+from dataset import load_dataset
+from geocode import search, admin_names
+
+LEVELS = ('city', 'area', 'region', 'country')
+# distance histogram: log-spaced bin edges from 1 to 20000 km (plus a first bin for < 1 km), for the medians
+DISTANCE_BINS = np.concatenate([[0], np.logspace(0, np.log10(20038), 64)])
+# GeoScore histogram: 10 bins of 500 points
+SCORE_BINS = np.linspace(0, 5000, 11)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS checkpoints (source TEXT PRIMARY KEY, position INTEGER)',
+    'CREATE TABLE IF NOT EXISTS images (image_id TEXT PRIMARY KEY, rounds INTEGER, sum_distance REAL, sum_score REAL, '
+    'sum_time REAL, correct TEXT, valid TEXT, distances TEXT, scores TEXT, avg_score REAL)',
+    'CREATE TABLE IF NOT EXISTS players (session TEXT PRIMARY KEY, rounds INTEGER, sum_distance REAL, sum_score REAL, '
+    'sum_time REAL, correct TEXT, valid TEXT, distances TEXT, scores TEXT, avg_score REAL, finished INTEGER)',
+    'CREATE INDEX IF NOT EXISTS images_score ON images (avg_score)',
+    'CREATE INDEX IF NOT EXISTS players_score ON players (finished, avg_score)',
+]
+
+
+def median_from_histogram(counts, edges):
+    # Median estimated by linear interpolation inside the bin that holds it
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return 0.
+    cumulative = np.cumsum(counts)
+    i = int(np.searchsorted(cumulative, total / 2))
+    before = cumulative[i - 1] if i > 0 else 0.
+    return float(edges[i] + (edges[i + 1] - edges[i]) * (total / 2 - before) / counts[i])
+
+
+class Aggregator(object):
+    # Reads the rounds written since the last update (files, jsonl or sqlite backend),
+    # geocodes them in one batch and folds them into per-image and per-player rows.
+    # The checkpoints are committed with the statistics, so each round is counted exactly once
+    def __init__(self, results_dir, csv_file, db_path=None):
+        self.results_dir = results_dir
+        self.dataset = load_dataset(csv_file)
+        self.index = {str(image_id): i for i, image_id in enumerate(self.dataset.image_ids.tolist())}
+        self.db = sqlite3.connect(db_path or os.path.join(results_dir, 'aggregates.db'))
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def checkpoint(self, source):
+        row = self.db.execute('SELECT position FROM checkpoints WHERE source = ?', (source,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def read_files(self, rounds, finished, checkpoints):
+        # Original layout: a session is read once, when its full.txt exists
+        for full in glob.glob(os.path.join(self.results_dir, '*', 'full.txt')):
+            session_dir = os.path.dirname(full)
+            session = os.path.basename(session_dir)
+            source = 'files:' + session
+            if self.checkpoint(source):
+                continue
+            for path in sorted(glob.glob(os.path.join(session_dir, '[0-9]*.txt'))):
+                index = int(os.path.basename(path)[:-4])
+                with open(path) as f:
+                    score, distance, lat, lon, time_elapsed = map(float, f.read().split(','))
+                image_id = str(self.dataset.image_ids[index - 1])
+                rounds.append((session, image_id, score, distance, lat, lon, time_elapsed))
+            finished.add(session)
+            checkpoints[source] = 1
+
+    def read_jsonl(self, rounds, finished, checkpoints):
+        for path in glob.glob(os.path.join(self.results_dir, 'results-*.jsonl')):
+            source = 'jsonl:' + os.path.basename(path)
+            position = self.checkpoint(source)
+            with open(path, 'rb') as f:
+                f.seek(position)
+                data = f.read()
+            # a line still being written is left for the next update
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                record = json.loads(line)
+                if record['type'] == 'click':
+                    rounds.append((record['session'], str(record['image_id']), record['score'], record['distance'],
+                                   record['lat'], record['lon'], record['time']))
+                else:
+                    finished.add(record['session'])
+            checkpoints[source] = position + end
+
+    def read_sqlite(self, rounds, finished, checkpoints):
+        path = os.path.join(self.results_dir, 'results.db')
+        if not os.path.exists(path):
+            return
+        db = sqlite3.connect(path)
+        for table in ('clicks', 'finals'):
+            source = 'sqlite:' + table
+            position = self.checkpoint(source)
+            if table == 'clicks':
+                rows = db.execute('SELECT rowid, session, image_id, score, distance, lat, lon, time FROM clicks WHERE rowid > ? ORDER BY rowid', (position,)).fetchall()
+                rounds.extend(row[1:] for row in rows)
+            else:
+                rows = db.execute('SELECT rowid, session FROM finals WHERE rowid > ? ORDER BY rowid', (position,)).fetchall()
+                finished.update(row[1] for row in rows)
+            if rows:
+                checkpoints[source] = rows[-1][0]
+        db.close()
+
+    def load_row(self, table, key_column, key):
+        row = self.db.execute(
+            f'SELECT rounds, sum_distance, sum_score, sum_time, correct, valid, distances, scores FROM {table} WHERE {key_column} = ?',
+            (key,)).fetchone()
+        if row is None:
+            return [0, 0., 0., 0., [0] * 4, [0] * 4, [0] * (len(DISTANCE_BINS) - 1), [0] * (len(SCORE_BINS) - 1)]
+        return list(row[:4]) + [json.loads(value) for value in row[4:]]
+
+    def fold(self, row, distance_hist, score_hist, rows, correct, valid):
+        row[0] += len(rows)
+        row[1] += sum(r[3] for r in rows)
+        row[2] += sum(r[2] for r in rows)
+        row[3] += sum(r[6] for r in rows)
+        row[4] = (np.asarray(row[4]) + correct).tolist()
+        row[5] = (np.asarray(row[5]) + valid).tolist()
+        row[6] = (np.asarray(row[6]) + distance_hist).tolist()
+        row[7] = (np.asarray(row[7]) + score_hist).tolist()
+        return row
+
+    def update(self):
+        rounds, finished, checkpoints = [], set(), {}
+        self.read_files(rounds, finished, checkpoints)
+        self.read_jsonl(rounds, finished, checkpoints)
+        self.read_sqlite(rounds, finished, checkpoints)
+
+        if rounds:
+            # Admin levels of all the new guesses in one geocoder query, scored as in Engine.finish
+            clicked = np.array([admin_names(r) for r in search([(r[4], r[5]) for r in rounds])], dtype=object)
+            true = np.array([self.dataset.admin(self.index[r[1]]) if r[1] in self.index else [float('nan')] * 4
+                             for r in rounds], dtype=object)
+            correct = (true == clicked).astype(np.int64)
+            valid = (true != 'nan').astype(np.int64)
+            distances = np.array([r[3] for r in rounds])
+            scores = np.array([r[2] for r in rounds])
+            distance_bins = np.clip(np.searchsorted(DISTANCE_BINS, distances, side='right') - 1, 0, len(DISTANCE_BINS) - 2)
+            score_bins = np.clip(np.searchsorted(SCORE_BINS, scores, side='right') - 1, 0, len(SCORE_BINS) - 2)
+
+        with self.db:
+            for table, key_column, column in (('images', 'image_id', 1), ('players', 'session', 0)):
+                groups = {}
+                for i, r in enumerate(rounds):
+                    groups.setdefault(r[column], []).append(i)
+                for key, members in groups.items():
+                    distance_hist = np.bincount(distance_bins[members], minlength=len(DISTANCE_BINS) - 1)
+                    score_hist = np.bincount(score_bins[members], minlength=len(SCORE_BINS) - 1)
+                    row = self.fold(self.load_row(table, key_column, key), distance_hist, score_hist,
+                                    [rounds[i] for i in members], correct[members].sum(axis=0), valid[members].sum(axis=0))
+                    values = row[:4] + [json.dumps(value) for value in row[4:]] + [row[2] / row[0]]
+                    if table == 'images':
+                        self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [key] + values)
+                    else:
+                        self.db.execute(
+                            'INSERT OR REPLACE INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                            'COALESCE((SELECT finished FROM players WHERE session = ?), 0))', [key] + values + [key])
+            self.db.executemany('UPDATE players SET finished = 1 WHERE session = ?', [(session,) for session in finished])
+            self.db.executemany('INSERT OR REPLACE INTO checkpoints VALUES (?, ?)', checkpoints.items())
+        return len(rounds)
+
+    def describe(self, key, row):
+        rounds, sum_distance, sum_score, sum_time = row[:4]
+        correct, valid, distances, scores = (json.loads(value) for value in row[4:8])
+        stats = {
+            'id': key,
+            'rounds': rounds,
+            'geoscore': sum_score / rounds,
+            'distance': sum_distance / rounds,
+            'median_distance': median_from_histogram(distances, DISTANCE_BINS),
+            'time': sum_time / rounds,
+            'scores': scores,
+        }
+        for level, c, v in zip(LEVELS, correct, valid):
+            stats[level + '_acc'] = c / v if v else 0
+        return stats
+
+    def leaderboard(self, n=10, finished_only=True):
+        rows = self.db.execute(
+            'SELECT session, rounds, sum_distance, sum_score, sum_time, correct, valid, distances, scores FROM players '
+            'WHERE finished >= ? ORDER BY avg_score DESC LIMIT ?', (int(finished_only), n)).fetchall()
+        return [self.describe(row[0], row[1:]) for row in rows]
+
+    def difficulty(self, n=10, hardest=True):
+        order = 'ASC' if hardest else 'DESC'
+        rows = self.db.execute(
+            'SELECT image_id, rounds, sum_distance, sum_score, sum_time, correct, valid, distances, scores FROM images '
+            f'ORDER BY avg_score {order} LIMIT ?', (n,)).fetchall()
+        return [self.describe(row[0], row[1:]) for row in rows]
+
+    def image(self, image_id):
+        row = self.db.execute(
+            'SELECT image_id, rounds, sum_distance, sum_score, sum_time, correct, valid, distances, scores FROM images '
+            'WHERE image_id = ?', (str(image_id),)).fetchone()
+        return self.describe(row[0], row[1:]) if row is not None else None
+
+
+def format_stats(stats):
+    return (f"{stats['id']}: {stats['rounds']} rounds, GeoScore {stats['geoscore']:.0f}, "
+            f"distance {stats['distance']:.0f} km (median {stats['median_distance']:.0f} km), "
+            f"Country Acc: {100*stats['country_acc']:.1f}, Region Acc: {100*stats['region_acc']:.1f}, "
+            f"time {stats['time']:.1f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Leaderboard and image difficulty from the game results')
+    parser.add_argument('--results_dir', type=str, required=False, help='Folder with the game results', default='./results')
+    parser.add_argument('--csv_file', type=str, required=False, help='CSV file of the images played', default='./select.csv')
+    parser.add_argument('--top', type=int, required=False, help='Number of lines to show', default=10)
+
+    args = parser.parse_args()
+
+    aggregator = Aggregator(args.results_dir, args.csv_file)
+    print(f"{aggregator.update()} new rounds")
+    print("# Leaderboard")
+    for stats in aggregator.leaderboard(args.top):
+        print(format_stats(stats))
+    print("# Hardest images")
+    for stats in aggregator.difficulty(args.top):
+        print(format_stats(stats))
@@ -0,0 +1,129 @@
+"""Headless benchmark of the Engine hot paths: python bench.py [--baseline bench.json]"""
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from collections import defaultdict
+import numpy as np
+import game
+from game import Engine, warm_up, get_pool
+from results import open_results
+from render import draw_click_overlay
+
+OPERATIONS = ('init', 'load_image', 'click', 'encode', 'next_image', 'finish')
+
+
+def play_games(games, seed, results, trace=False):
+    # Plays full games with random clicks, returns the samples of each operation:
+    # seconds, or peak bytes allocated on the Python heap when tracing (pixel buffers of PIL are not seen)
+    rng = random.Random(seed)
+    samples = defaultdict(list)
+
+    def measure(name, fn, *args):
+        if trace:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            out = fn(*args)
+            samples[name].append(tracemalloc.get_traced_memory()[1] - before)
+        else:
+            start = time.perf_counter()
+            out = fn(*args)
+            samples[name].append(time.perf_counter() - start)
+        return out
+
+    for g in range(games):
+        engine = measure('init', lambda: Engine(game.IMAGE_FOLDER, game.CSV_FILE, f"bench{g}", results=results))
+        measure('load_image', engine.load_image)
+        while True:
+            x, y = rng.uniform(0, engine.width), rng.uniform(0, engine.height)
+            measure('click', engine.click, x, y)
+
+            # the encoding part of a click on its own (what get_figure used to do)
+            lon, lat = engine.normalize_pixels(x, y)
+            true_lon, true_lat = engine.dataset.coordinates[engine.index]
+            with get_pool().checkout() as renderer:
+                pil = draw_click_overlay(renderer.base_map, lon, lat, true_lon, true_lat)
+                measure('encode', renderer.encoder.encode, pil)
+
+            if engine.isfinal():
+                break
+            measure('next_image', engine.next_image)
+        measure('finish', engine.finish)
+    return samples
+
+
+def summarize(samples, allocations):
+    report = {}
+    for name in OPERATIONS:
+        values = np.array(samples.get(name, [0.]))
+        report[name] = {
+            'count': len(samples.get(name, [])),
+            'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(values.max()),
+            'alloc_bytes': float(np.mean(allocations.get(name, [0]))),
+        }
+    return report
+
+
+def compare(report, baseline, tolerance):
+    # Regression: p50 or p99 slower than the baseline by more than the tolerance
+    regressions = []
+    for name, stats in report.items():
+        if not isinstance(stats, dict) or name not in baseline or 'p50' not in stats:
+            continue
+        for key in ('p50', 'p99'):
+            before, after = baseline[name][key], stats[key]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append(f"{name} {key}: {1000*before:.2f} ms -> {1000*after:.2f} ms")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the Engine hot paths')
+    parser.add_argument('--games', type=int, required=False, help='Number of full games played', default=5)
+    parser.add_argument('--seed', type=int, required=False, help='Seed of the synthetic clicks', default=0)
+    parser.add_argument('--output', type=str, required=False, help='Write the report to this JSON file', default=None)
+    parser.add_argument('--baseline', type=str, required=False, help='Report of a previous run to compare against', default=None)
+    parser.add_argument('--tolerance', type=float, required=False, help='Allowed slowdown before failing, as a fraction', default=0.2)
+    parser.add_argument('--no_trace', action='store_true', help='Skip the allocation pass')
+
+    args = parser.parse_args()
+
+    results = open_results(tempfile.mkdtemp(prefix='plonk_bench_'), 'jsonl', 'none')
+    report = {'warm_up': warm_up()}
+
+    samples = play_games(args.games, args.seed, results)
+    allocations = {}
+    if not args.no_trace:
+        # a separate, shorter pass: tracing slows everything down
+        tracemalloc.start()
+        allocations = play_games(1, args.seed, results, trace=True)
+        tracemalloc.stop()
+    report.update(summarize(samples, allocations))
+    # ru_maxrss is in kilobytes on Linux
+    report['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f"{'operation':<12}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'py KB':>10}")
+    for name in OPERATIONS:
+        stats = report[name]
+        print(f"{name:<12}{stats['count']:>7}{1000*stats['p50']:>10.2f}{1000*stats['p90']:>10.2f}"
+              f"{1000*stats['p99']:>10.2f}{1000*stats['max']:>10.2f}{stats['alloc_bytes']/1024:>10.1f}")
+    print(f"peak RSS: {report['peak_rss_mb']:.0f} MB, warm up: " +
+          ', '.join(f"{phase} {elapsed:.2f}s" for phase, elapsed in report['warm_up'].items()))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
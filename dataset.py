@@ -0,0 +1,123 @@
+"""Round dataset, loaded once per process and shared read-only by all game sessions"""
+import os
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+ADMIN_LEVELS = ('city', 'area', 'region', 'country')
+
+
+class Dataset(object):
+    # image_ids: (n,) array, coordinates: (n, 2) float64 array of (longitude, latitude),
+    # admin_codes: (n, 4) int32 array of indices into admin_names, -1 when missing
+    __slots__ = ('image_ids', 'coordinates', 'admin_codes', 'admin_names')
+
+    def __init__(self, image_ids, coordinates, admin_codes, admin_names):
+        for array in (image_ids, coordinates, admin_codes):
+            if array.flags.writeable:
+                array.setflags(write=False)
+        self.image_ids = image_ids
+        self.coordinates = coordinates
+        self.admin_codes = admin_codes
+        self.admin_names = tuple(tuple(names) for names in admin_names)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def admin(self, index):
+        # city, area, region, country of an image, missing values are NaN as when read by pandas
+        return [names[code] if code >= 0 else float('nan') for names, code in zip(self.admin_names, self.admin_codes[index])]
+
+    @classmethod
+    def from_csv(cls, csv_file):
+        # pandas is only needed when the CSV has to be parsed, not when the cached arrays are mapped
+        import pandas as pd
+
+        df = pd.read_csv(csv_file)
+        image_ids = df['image_id'].to_numpy()
+        if image_ids.dtype == object:
+            image_ids = image_ids.astype(str)
+        coordinates = df[['longitude', 'latitude']].to_numpy(dtype=np.float64)
+        admin_codes = np.empty((len(df), len(ADMIN_LEVELS)), dtype=np.int32)
+        admin_names = []
+        for i, level in enumerate(ADMIN_LEVELS):
+            categorical = pd.Categorical(df[level])
+            admin_codes[:, i] = categorical.codes
+            admin_names.append(categorical.categories.tolist())
+        return cls(image_ids, coordinates, admin_codes, admin_names)
+
+    def save(self, directory):
+        # Plain .npy files, so other worker processes can map them instead of holding a copy.
+        # Written to a temporary directory next to it and renamed into place, as metrics.dump does,
+        # so a worker mapping the arrays never reads half-written ones
+        parent = os.path.dirname(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.' + os.path.basename(directory) + '.', dir=parent)
+        np.save(os.path.join(tmp, 'image_ids.npy'), self.image_ids)
+        np.save(os.path.join(tmp, 'coordinates.npy'), self.coordinates)
+        np.save(os.path.join(tmp, 'admin_codes.npy'), self.admin_codes)
+        with open(os.path.join(tmp, 'admin_names.json'), 'w') as f:
+            json.dump(self.admin_names, f)
+        # a directory is only renamed onto an empty one: a stale copy is moved aside first,
+        # the processes still mapping its files keep reading them until they are done
+        old = tmp + '.old'
+        try:
+            os.replace(directory, old)
+        except FileNotFoundError:
+            old = None
+        try:
+            os.replace(tmp, directory)
+        except OSError:
+            # another worker put the same arrays in place in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        image_ids = np.load(os.path.join(directory, 'image_ids.npy'), mmap_mode=mmap_mode)
+        coordinates = np.load(os.path.join(directory, 'coordinates.npy'), mmap_mode=mmap_mode)
+        admin_codes = np.load(os.path.join(directory, 'admin_codes.npy'), mmap_mode=mmap_mode)
+        with open(os.path.join(directory, 'admin_names.json')) as f:
+            admin_names = json.load(f)
+        return cls(image_ids, coordinates, admin_codes, admin_names)
+
+
+_datasets = {}
+_datasets_lock = threading.Lock()
+
+
+def is_fresh(cache_dir, csv_file):
+    stamp = os.path.join(cache_dir, 'admin_names.json')
+    return os.path.exists(stamp) and os.path.getmtime(stamp) >= os.path.getmtime(csv_file)
+
+
+def load_dataset(csv_file, cache_dir=None):
+    # Parse the CSV once per process. With a cache_dir, the arrays are written there once
+    # and memory-mapped, so the pages are shared by all the worker processes of the machine
+    key = os.path.abspath(csv_file)
+    dataset = _datasets.get(key)
+    if dataset is None:
+        with _datasets_lock:
+            dataset = _datasets.get(key)
+            if dataset is None:
+                if cache_dir is not None and is_fresh(cache_dir, csv_file):
+                    try:
+                        dataset = Dataset.load(cache_dir)
+                    except FileNotFoundError:
+                        # moved aside by a worker replacing it right then
+                        dataset = None
+                if dataset is None:
+                    dataset = Dataset.from_csv(csv_file)
+                    if cache_dir is not None:
+                        dataset.save(cache_dir)
+                        try:
+                            dataset = Dataset.load(cache_dir)
+                        except FileNotFoundError:
+                            # same race: this process keeps the copy it parsed
+                            pass
+                _datasets[key] = dataset
+    return dataset
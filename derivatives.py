@@ -0,0 +1,156 @@
+"""Display-sized copies of the round images, built once ahead of the games:
+python derivatives.py --image_folder ./select rebuilds only what changed since the last run"""
+import io
+import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+WIDTHS = (480, 960)
+FORMATS = {'jpeg': 'JPEG', 'webp': 'WEBP'}
+QUALITY = 80
+MANIFEST_FILE = 'manifest.json'
+
+
+def content_hash(data):
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+def encode(pil, fmt, quality):
+    buf = io.BytesIO()
+    pil.save(buf, format=FORMATS[fmt], quality=quality)
+    return buf.getvalue()
+
+
+def build_image(source, output_dir, widths=WIDTHS, formats=tuple(FORMATS), quality=QUALITY):
+    # Every width and format of one image. Names carry a hash of their content,
+    # so a changed image never reuses the name (and the browser cache) of the old one
+    with open(source, 'rb') as f:
+        data = f.read()
+    image_id = os.path.splitext(os.path.basename(source))[0]
+    pil = Image.open(source)
+    # the largest width is enough for the decoder, smaller ones are resized from it
+    pil.draft('RGB', (max(widths), pil.size[1] * max(widths) // pil.size[0]))
+    pil = pil.convert('RGB')
+    files = {}
+    for width in widths:
+        resized = pil.copy()
+        # never upscaled: a narrow original is only re-encoded
+        resized.thumbnail((width, resized.size[1]))
+        for fmt in formats:
+            out = encode(resized, fmt, quality)
+            name = f"{image_id}-{width}-{content_hash(out)}.{fmt}"
+            with open(os.path.join(output_dir, name), 'wb') as f:
+                f.write(out)
+            files[f"{width}.{fmt}"] = {'file': name, 'size': resized.size, 'bytes': len(out)}
+    stat = os.stat(source)
+    return image_id, {'source': os.path.basename(source), 'hash': content_hash(data),
+                      'mtime': stat.st_mtime_ns, 'bytes': stat.st_size, 'files': files}
+
+
+def read_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {'settings': None, 'images': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def build(image_folder, output_dir, widths=WIDTHS, formats=tuple(FORMATS), quality=QUALITY, workers=None):
+    # Returns the number of images (re)built and removed
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = read_manifest(output_dir)
+    settings = {'widths': list(widths), 'formats': list(formats), 'quality': quality}
+    old_files = set()
+    if manifest['settings'] != settings:
+        # different widths, formats or quality: everything is rebuilt
+        old_files = {info['file'] for entry in manifest['images'].values() for info in entry['files'].values()}
+        manifest = {'settings': settings, 'images': {}}
+    images = manifest['images']
+
+    todo = []
+    present = set()
+    with os.scandir(image_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.jpg'):
+                continue
+            image_id = entry.name[:-4]
+            present.add(image_id)
+            known = images.get(image_id)
+            stat = entry.stat()
+            # size and mtime first, the content hash only when they changed (e.g. a copy of the same file)
+            if known is not None and (known['mtime'], known['bytes']) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            if known is not None:
+                with open(entry.path, 'rb') as f:
+                    if content_hash(f.read()) == known['hash']:
+                        known['mtime'], known['bytes'] = stat.st_mtime_ns, stat.st_size
+                        continue
+            todo.append(entry.path)
+
+    removed = [image_id for image_id in images if image_id not in present]
+    old_files |= {info['file'] for image_id in removed + [os.path.basename(p)[:-4] for p in todo] if image_id in images
+                 for info in images[image_id]['files'].values()}
+    for image_id in removed:
+        del images[image_id]
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for image_id, entry in executor.map(build_image, todo, [output_dir] * len(todo), [tuple(widths)] * len(todo),
+                                                [tuple(formats)] * len(todo), [quality] * len(todo), chunksize=8):
+                images[image_id] = entry
+    write_manifest(output_dir, manifest)
+
+    # files of replaced or deleted images, removed once the manifest no longer points at them
+    current = {info['file'] for entry in images.values() for info in entry['files'].values()}
+    for name in old_files - current:
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    return len(todo), len(removed)
+
+
+class Derivatives(object):
+    # Lookup of the derivative to send for an image_id, from a manifest written by build()
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.images = read_manifest(output_dir)['images']
+
+    def path(self, image_id, width, fmt='jpeg'):
+        # The smallest derivative at least width pixels wide (the widest when none is),
+        # None when the image or the format was not built
+        entry = self.images.get(str(image_id))
+        if entry is None:
+            return None
+        candidates = sorted((int(key.split('.')[0]), info['file']) for key, info in entry['files'].items()
+                            if key.split('.')[1] == fmt)
+        if not candidates:
+            return None
+        for candidate_width, name in candidates:
+            if candidate_width >= width:
+                break
+        return os.path.join(self.output_dir, name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build display-sized copies of the round images')
+    parser.add_argument('--image_folder', type=str, required=False, help='Folder with the original images', default='./select')
+    parser.add_argument('--output_dir', type=str, required=False, help='Folder of the derivatives (default: <image_folder>_display)', default=None)
+    parser.add_argument('--widths', type=int, nargs='+', required=False, help='Widths generated, in pixels', default=list(WIDTHS))
+    parser.add_argument('--formats', type=str, nargs='+', required=False, help='Formats generated (jpeg, webp)', default=list(FORMATS))
+    parser.add_argument('--quality', type=int, required=False, help='Encoding quality', default=QUALITY)
+    parser.add_argument('--workers', type=int, required=False, help='Processes encoding the images (default: one per core)', default=None)
+
+    args = parser.parse_args()
+    output_dir = args.output_dir or args.image_folder.rstrip('/') + '_display'
+    built, removed = build(args.image_folder, output_dir, args.widths, args.formats, args.quality, args.workers)
+    print(f"{built} images built, {removed} removed, manifest in {os.path.join(output_dir, MANIFEST_FILE)}")
@@ -0,0 +1,104 @@
+"""Score a file of model predictions the way the game scores players, without clicking through the UI"""
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from geocode import search, admin_names
+
+R = 6371  # radius of the earth in km
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Same as game.haversine, on arrays
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+
+def geoscore(d):
+    return 5000 * np.exp(-d / 1492.7)
+
+
+class Evaluation(object):
+    # Running totals, filled chunk by chunk
+    def __init__(self):
+        # float32 is plenty for the median, the means are summed in float64
+        self.distances = []
+        self.sum_distance = 0.
+        self.sum_score = 0.
+        self.correct = np.zeros(4, dtype=np.int64)
+        self.valid = np.zeros(4, dtype=np.int64)
+
+    def add(self, distances, clicked_admins, true_admins):
+        self.distances.append(distances.astype(np.float32))
+        self.sum_distance += distances.sum()
+        self.sum_score += geoscore(distances).sum()
+        # same rules as Engine.finish: missing ground truth is NaN and still counts as valid
+        self.valid += (true_admins != 'nan').sum(axis=0)
+        self.correct += (true_admins == clicked_admins).sum(axis=0)
+
+    def results(self):
+        distances = np.concatenate(self.distances) if self.distances else np.zeros(0, dtype=np.float32)
+        n = len(distances)
+        accuracies = self.correct / np.maximum(self.valid, 1)
+        return {
+            'count': n,
+            'geoscore': float(self.sum_score / n) if n else 0,
+            'distance': float(self.sum_distance / n) if n else 0,
+            'median_distance': float(np.median(distances)) if n else 0,
+            'country_acc': float(accuracies[3]),
+            'region_acc': float(accuracies[2]),
+            'area_acc': float(accuracies[1]),
+            'city_acc': float(accuracies[0]),
+        }
+
+
+def evaluate(csv_file, pred_lat='pred_latitude', pred_lon='pred_longitude', admin_columns=None, chunksize=100000):
+    evaluation = Evaluation()
+    for chunk in pd.read_csv(csv_file, chunksize=chunksize):
+        if admin_columns is None:
+            # select.csv calls the second level 'area', the prediction files 'sub-region'
+            area = 'area' if 'area' in chunk.columns else 'sub-region'
+            admin_columns = ['city', area, 'region', 'country']
+        lats = chunk[pred_lat].to_numpy(dtype=np.float64)
+        lons = chunk[pred_lon].to_numpy(dtype=np.float64)
+        distances = haversine(chunk['latitude'], chunk['longitude'], lats, lons)
+
+        # one geocoder query for the whole chunk
+        clicks = search(list(zip(lats.tolist(), lons.tolist())))
+        clicked_admins = np.array([admin_names(click) for click in clicks], dtype=object)
+        true_admins = chunk[admin_columns].to_numpy(dtype=object)
+        evaluation.add(distances, clicked_admins, true_admins)
+    return evaluation.results()
+
+
+def format_results(results):
+    return (
+        f"Average GeoScore: {results['geoscore']:.0f}, "
+        f"Average distance: {results['distance']:.0f} km, "
+        f"Median distance: {results['median_distance']:.0f} km, "
+        f"Country Acc: {100*results['country_acc']:.1f}, "
+        f"Region Acc: {100*results['region_acc']:.1f}, "
+        f"Area Acc: {100*results['area_acc']:.1f}, "
+        f"City Acc: {100*results['city_acc']:.1f} "
+        f"({results['count']} images)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Score model predictions with the game metrics')
+    parser.add_argument('--csv_file', type=str, required=False, help='CSV file with ground truth and predictions', default='./select2.csv')
+    parser.add_argument('--pred_lat', type=str, required=False, help='Column with the predicted latitude', default='pred_latitude')
+    parser.add_argument('--pred_lon', type=str, required=False, help='Column with the predicted longitude', default='pred_longitude')
+    parser.add_argument('--admin_columns', type=str, required=False, help='Comma separated city, area, region and country columns (default: guessed)', default=None)
+    parser.add_argument('--chunksize', type=int, required=False, help='Rows scored at a time', default=100000)
+    parser.add_argument('--output', type=str, required=False, help='Also write the results to this JSON file', default=None)
+
+    args = parser.parse_args()
+
+    admin_columns = args.admin_columns.split(',') if args.admin_columns else None
+    results = evaluate(args.csv_file, args.pred_lat, args.pred_lon, admin_columns, args.chunksize)
+    print(format_results(results))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
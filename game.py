@@ -1,23 +1,84 @@
 """Requires gradio==3.44.0"""
-import io
 import os
 import uuid
-import matplotlib
 import time
-matplotlib.use('Agg')
-from os.path import join
-from PIL import Image
-import pandas as pd
-import reverse_geocoder as rg
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import matplotlib.pyplot as plt
+import struct
+import asyncio
+import threading
 from math import radians, sin, cos, sqrt, asin, exp
+import numpy as np
 from collections import defaultdict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from render import MapEncoder, RendererPool
+from dataset import load_dataset, ADMIN_LEVELS
+from images import ImageCache
+from derivatives import Derivatives
+from geocode import AdminTally, warm
+import admin_polygons
+from results import open_results
+from session_store import SessionStore, SessionManager
+from metrics import span, incr, profile, get_profiler, enable, enabled, drain, merge, serve, dump_periodically, add_collector
 
 IMAGE_FOLDER = './select'
 CSV_FILE = './select.csv'
 RESULTS_DIR = './results'
+# Where results go (files: one text file per click, jsonl: append-only log, sqlite: WAL database)
+# and how hard the background writer pushes them to disk (none, flush or fsync)
+RESULTS_BACKEND = 'jsonl'
+RESULTS_DURABILITY = 'flush'
+# Directory where the parsed CSV is kept as memory-mapped arrays shared by worker processes (None: in memory only)
+DATASET_CACHE = None
+# Map images: format (png, jpeg or webp), resolution, lossy quality and
+# how they are handed to Gradio (pil or path; path avoids a second encode)
+MAP_FORMAT = 'png'
+MAP_DPI = 300
+MAP_QUALITY = 85
+MAP_OUTPUT = 'path'
+# Size budget of a jpeg or webp map in bytes: the quality is lowered until it fits (None: no budget)
+MAP_MAX_BYTES = None
+# Number of maps rendered at the same time, whatever the number of players
+RENDER_WORKERS = os.cpu_count()
+# Round images: display size (None: sent as they are on disk), number kept decoded and prefetched ahead
+IMAGE_SIZE = None
+IMAGE_CACHE_SIZE = 16
+IMAGE_PREFETCH = 2
+# Folder written by derivatives.py: images are then sent at IMAGE_WIDTH in IMAGE_FORMAT (jpeg or webp)
+# instead of as the originals (None: originals, resized to IMAGE_SIZE if set)
+IMAGE_DERIVATIVES = None
+IMAGE_WIDTH = 960
+IMAGE_FORMAT = 'jpeg'
+# How city/area/region/country accuracy is scored: 'geocoder' compares the nearest populated place of the click
+# with the CSV columns, 'polygons' compares the country and region polygons of the click and of the true location
+# (exact near borders, no city or area; needs admin_polygons.npz, see admin_polygons.py)
+ADMIN_SCORING = 'geocoder'
+# Gradio queue: events processed at the same time, and events waiting before new ones are refused (None: no limit)
+QUEUE_CONCURRENCY = 16
+QUEUE_SIZE = 64
+# Threads the callbacks run their blocking work on, more than RENDER_WORKERS so starting a game or scoring a click
+# never waits behind the clicks queued for a renderer (None: RENDER_WORKERS + QUEUE_CONCURRENCY)
+CALLBACK_WORKERS = None
+# Stage timings and session counters: local port serving /metrics (Prometheus) and /metrics.json,
+# and/or a JSON file rewritten every METRICS_INTERVAL seconds (both None: nothing is recorded)
+METRICS_PORT = None
+METRICS_DUMP = None
+METRICS_INTERVAL = 10.
+# Folder where the stacks sampled in the sessions started with ?profile=1 are written (None: no profiling)
+PROFILE_DIR = None
+# Multi-process mode: worker processes serving the sessions (0: everything in the Gradio process),
+# and the SQLite file the sessions are kept in between two requests
+WORKERS = 0
+SESSION_STORE = './results/sessions.db'
+# Sessions of the single-process mode: moved to the SESSION_STORE after SESSION_TTL seconds without a request,
+# or when more than MAX_SESSIONS are in memory, and brought back when the player returns
+SESSION_TTL = 600.
+MAX_SESSIONS = 1000
+# Sessions stored and not played for SESSION_KEEP seconds are deleted, checked every SESSION_SWEEP seconds at most
+SESSION_KEEP = 7 * 24 * 3600.
+SESSION_SWEEP = 60.
+# index, clock, rounds played, then correct and valid counts of the 4 admin levels
+SESSION_HEADER = struct.Struct('<IdI4I4I')
 RULES = """# Plonk 🌍 🌎 🌏
 ## Total time: 50 pictures ~ 5min
 ### How it works:
@@ -45,55 +106,196 @@ def geoscore(d):
     return 5000 * exp(-d / 1492.7)
 
 
+def summary_path(cache_path):
+    # the recap map of a finished game, next to its results
+    return os.path.join(cache_path, 'summary.' + MAP_FORMAT)
+
+
+_pool = None
+_image_cache = None
+_results = None
+_executor = None
+_derivatives = None
+_store = None
+_sessions = None
+# the shared objects below are created once, by whichever session asks first
+_shared_lock = threading.RLock()
+
+def get_pool():
+    # One renderer pool (and encoder) for all sessions of the process
+    global _pool
+    if _pool is None:
+        with _shared_lock:
+            if _pool is None:
+                _pool = RendererPool(RENDER_WORKERS, MapEncoder(MAP_FORMAT, MAP_QUALITY, MAP_OUTPUT, MAP_MAX_BYTES), MAP_DPI)
+    return _pool
+
+def get_image_cache():
+    # One cache for all sessions: every player sees the same images
+    global _image_cache
+    if _image_cache is None:
+        with _shared_lock:
+            if _image_cache is None:
+                _image_cache = ImageCache(IMAGE_CACHE_SIZE, IMAGE_SIZE, MapEncoder('jpeg', MAP_QUALITY, 'path'))
+    return _image_cache
+
+
+def get_derivatives():
+    # The manifest is read once per process, None when no derivatives were built
+    global _derivatives
+    if _derivatives is None and IMAGE_DERIVATIVES is not None:
+        with _shared_lock:
+            if _derivatives is None:
+                _derivatives = Derivatives(IMAGE_DERIVATIVES)
+    return _derivatives
+
+
+def get_results():
+    # One background writer for all sessions of the process
+    global _results
+    if _results is None:
+        with _shared_lock:
+            if _results is None:
+                _results = open_results(RESULTS_DIR, RESULTS_BACKEND, RESULTS_DURABILITY)
+    return _results
+
+
+def get_executor():
+    # Threads the async callbacks hand their slow work (drawing, decoding, geocoding, session I/O) to,
+    # so the Gradio event loop is never blocked by a render
+    global _executor
+    if _executor is None:
+        with _shared_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS or RENDER_WORKERS + QUEUE_CONCURRENCY,
+                                               thread_name_prefix='callback')
+    return _executor
+
+
+async def run_async(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), fn, *args)
+
+
+def warm_up():
+    # Pay everything the first player would otherwise wait for, before accepting traffic
+    timings = {}
+    start = time.perf_counter()
+    load_dataset(CSV_FILE, DATASET_CACHE)
+    timings['dataset'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if ADMIN_SCORING == 'polygons':
+        admin_polygons.dataset_codes(load_dataset(CSV_FILE, DATASET_CACHE))
+        timings['admin polygons'] = time.perf_counter() - start
+    else:
+        warm()
+        timings['geocoder'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_pool().base()
+    timings['base map'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    get_image_cache()
+    get_derivatives()
+    get_results()
+    get_executor()
+    get_sessions()
+    timings['workers'] = time.perf_counter() - start
+    return timings
+
+
 class Engine(object):
-    def __init__(self, image_folder, csv_file, cache_path):
+    # Per-session game state only: maps are drawn by renderers borrowed from the shared pool
+    __slots__ = (
+        'image_folder', 'dataset', 'cache_path', 'pool', 'image_cache', 'results',
+        'index', 'stats', 'tally', 'time', 'width', 'height', 'MIN_LON', 'MAX_LON', 'MIN_LAT', 'MAX_LAT',
+    )
+    # what belongs to the session alone, the rest is shared by all of them
+    OWN_SLOTS = ('cache_path', 'index', 'stats', 'tally', 'time')
+
+    def __init__(self, image_folder, csv_file, cache_path, pool=None, image_cache=None, results=None):
         self.image_folder = image_folder
+        self.pool = pool if pool is not None else get_pool()
+        self.image_cache = image_cache if image_cache is not None else get_image_cache()
+        self.results = results if results is not None else get_results()
         self.load_images_and_coordinates(csv_file)
         self.cache_path = cache_path
           
         # Initialize the score and distance lists
         self.index = 0
         self.stats = defaultdict(list)
+        self.tally = admin_polygons.PolygonTally() if ADMIN_SCORING == 'polygons' else AdminTally()
+        # reset by load_image when the first image is shown
+        self.time = time.time()
 
-        # Create the figure and canvas only once
-        self.fig = plt.Figure(figsize=(10, 6))
-        self.ax = self.fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
-        self.MIN_LON, self.MAX_LON, self.MIN_LAT, self.MAX_LAT = self.ax.get_extent()
+        # The map is drawn from the shared base raster, only its geometry is needed here.
+        # Its pixel size follows the dpi, so normalize_pixels always matches the image sent
+        base = self.pool.base_map
+        self.width, self.height = base.size
+        self.MIN_LON, self.MAX_LON, self.MIN_LAT, self.MAX_LAT = base.extent
+
+    def to_state(self):
+        # Everything a session needs to go on in another process, in a few hundred bytes:
+        # a fixed header then one row of (time, lat, lon, score, distance) per round played
+        header = SESSION_HEADER.pack(self.index, self.time, len(self.stats['scores']), *self.tally.correct, *self.tally.valid)
+        rounds = np.column_stack([
+            np.asarray(self.stats['times'], dtype=np.float64).reshape(-1),
+            np.asarray(self.stats['clicked_locations'], dtype=np.float64).reshape(-1, 2),
+            np.asarray(self.stats['scores'], dtype=np.float64).reshape(-1),
+            np.asarray(self.stats['distances'], dtype=np.float64).reshape(-1),
+        ])
+        return header + rounds.tobytes()
+
+    @classmethod
+    def from_state(cls, state, image_folder, csv_file, cache_path, pool=None, image_cache=None, results=None):
+        engine = cls(image_folder, csv_file, cache_path, pool, image_cache, results)
+        fields = SESSION_HEADER.unpack_from(state)
+        engine.index, engine.time, n = fields[:3]
+        engine.tally.correct, engine.tally.valid = list(fields[3:7]), list(fields[7:11])
+        rounds = np.frombuffer(state, dtype=np.float64, offset=SESSION_HEADER.size).reshape(n, 5)
+        engine.stats['times'] = rounds[:, 0].tolist()
+        engine.stats['clicked_locations'] = [tuple(location) for location in rounds[:, 1:3].tolist()]
+        engine.stats['scores'] = rounds[:, 3].tolist()
+        engine.stats['distances'] = rounds[:, 4].tolist()
+        return engine
 
     def load_images_and_coordinates(self, csv_file):
-        # Load the CSV
-        df = pd.read_csv(csv_file)
-
-        # Get the image filenames and their coordinates
-        self.images = df['image_id'].tolist()[:]
-        self.coordinates = df[['longitude', 'latitude']].values.tolist()[:]
-        self.admins = df[['city', 'area', 'region', 'country']].values.tolist()[:]
+        # The CSV is parsed once per process, sessions share the read-only dataset
+        self.dataset = load_dataset(csv_file, DATASET_CACHE)
 
 
     def isfinal(self):
-        return self.index == len(self.images)-1
+        return self.index == len(self.dataset)-1
 
     def load_image(self):
-        if self.index > len(self.images)-1:          
+        if self.index > len(self.dataset)-1:          
             self.master.update_idletasks()
             self.finish()
 
-        self.ax.clear()
-        self.ax.set_global()
-        self.ax.stock_img()
-        self.ax.add_feature(cfeature.COASTLINE)
-        self.ax.add_feature(cfeature.BORDERS, linestyle=':')
-        self.fig.canvas.draw()
-        pil = self.get_figure()
+        # The background is the same for every image: reuse the process-wide raster,
+        # without queueing behind the click maps being drawn
+        fig = self.pool.base()
+        image = self.image_cache.get(self.image_path(self.index))
+        # Prepare the next images while the player is guessing this one
+        for index in range(self.index + 1, min(self.index + 1 + IMAGE_PREFETCH, len(self.dataset))):
+            self.image_cache.prefetch(self.image_path(index))
         self.set_clock()
-        return pil, os.path.join(self.image_folder, f"{self.images[self.index]}.jpg"), '### ' + str(self.index + 1) + '/' + str(len(self.images))
-
-    def get_figure(self):
-        img_buf = io.BytesIO()
-        self.fig.savefig(img_buf, format='png', bbox_inches='tight', pad_inches=0, dpi=300)
-        pil = Image.open(img_buf)
-        self.width, self.height = pil.size
-        return pil
+        return fig, image, '### ' + str(self.index + 1) + '/' + str(len(self.dataset))
+
+    def true_admin(self, index):
+        # what the click is compared with: CSV names, or the polygons of the true location
+        if ADMIN_SCORING == 'polygons':
+            return admin_polygons.dataset_codes(self.dataset)[index]
+        return self.dataset.admin(index)
+
+    def image_path(self, index):
+        derivatives = get_derivatives()
+        if derivatives is not None:
+            path = derivatives.path(self.dataset.image_ids[index], IMAGE_WIDTH, IMAGE_FORMAT)
+            if path is not None:
+                return path
+        return os.path.join(self.image_folder, f"{self.dataset.image_ids[index]}.jpg")
 
     def normalize_pixels(self, click_lon, click_lat):
         return self.MIN_LON + click_lon * (self.MAX_LON-self.MIN_LON) / self.width, self.MIN_LAT + (self.height - click_lat+1) * (self.MAX_LAT-self.MIN_LAT) / self.height
@@ -105,6 +307,11 @@ class Engine(object):
         return time.time() - self.time
 
     def click(self, click_lon, click_lat):
+        result_text, location = self.score_click(click_lon, click_lat)
+        return self.render_click(*location), result_text
+
+    def score_click(self, click_lon, click_lat):
+        # Everything but the map: the text can be shown before the map is drawn
         time_elapsed = self.get_clock()
         self.stats['times'].append(time_elapsed)
 
@@ -113,11 +320,9 @@ class Engine(object):
         # lon and lat is in degrees
         click_lon, click_lat = self.normalize_pixels(click_lon, click_lat)
         self.stats['clicked_locations'].append((click_lat, click_lon))
-        true_lon, true_lat = self.coordinates[self.index]
-
-        self.ax.plot(click_lon, click_lat, 'bo', transform=ccrs.Geodetic())
-        self.ax.plot([true_lon, click_lon], [true_lat, click_lat], color='blue', linewidth=1, transform=ccrs.Geodetic())
-        self.ax.plot(true_lon, true_lat, 'rx', transform=ccrs.Geodetic())
+        true_lon, true_lat = self.dataset.coordinates[self.index]
+        # Geocoded as the clicks come, finish() only has to read the counters
+        self.tally.submit(click_lat, click_lon, self.true_admin(self.index))
               
         distance = haversine(true_lat, true_lon, click_lat, click_lon)
         score = geoscore(distance)
@@ -128,7 +333,13 @@ class Engine(object):
         result_text = (f"### GeoScore: {score:.0f}, distance: {distance:.0f} km\n  ")
        
         self.cache(self.index+1, score, distance, (click_lat, click_lon), time_elapsed)
-        return self.get_figure(), result_text + average_text
+        incr('rounds_served')
+        return result_text + average_text, (click_lon, click_lat, true_lon, true_lat)
+
+    def render_click(self, click_lon, click_lat, true_lon, true_lat):
+        # Markers and great-circle line are drawn straight onto a copy of the base raster
+        with self.pool.checkout() as renderer:
+            return renderer.click(click_lon, click_lat, true_lon, true_lat)
 
     def next_image(self):
         # Go to the next image
@@ -140,95 +351,398 @@ class Engine(object):
         avg_score = sum(self.stats['scores']) / len(self.stats['scores']) if self.stats['scores'] else 0
         avg_distance = sum(self.stats['distances']) / len(self.stats['distances']) if self.stats['distances'] else 0
 
+        # Admin accuracies over the clicks played so far
+        _, _, avg_region_accuracy, avg_country_accuracy = self.tally.accuracies()
+
         # Update the text box
-        return f"### Average GeoScore: {avg_score:.0f}, Average distance: {avg_distance:.0f} km"
+        return (f"### Average GeoScore: {avg_score:.0f}, Average distance: {avg_distance:.0f} km  \n"
+                f"### Country Acc: {100*avg_country_accuracy:.1f}, Region Acc: {100*avg_region_accuracy:.1f}")
     
     def finish(self):
-        clicks = rg.search(self.stats['clicked_locations'])
-        clicked_admins = [[click['name'], click['admin2'], click['admin1'], click['cc']] for click in clicks]
-        
-        correct = [0,0,0,0]
-        valid = [0,0,0,0]
-        
-        for clicked_admin, true_admin in zip(clicked_admins, self.admins):
-            for i in range(4):
-                if true_admin[i]!= 'nan':
-                    valid[i] += 1
-                if true_admin[i] == clicked_admin[i]:
-                    correct[i] += 1
-                    
-        avg_city_accuracy = correct[0] / valid[0]
-        avg_area_accuracy = correct[1] / valid[1]
-        avg_region_accuracy = correct[2] / valid[2]
-        avg_country_accuracy = correct[3] / valid[3]
+        # The clicks were geocoded as they came
+        accuracies = dict(zip(ADMIN_LEVELS, self.tally.accuracies()))
         
         avg_score = sum(self.stats['scores']) / len(self.stats['scores']) if self.stats['scores'] else 0
         avg_distance = sum(self.stats['distances']) / len(self.stats['distances']) if self.stats['distances'] else 0
 
-        final_results = (
-            f"Average GeoScore: {avg_score:.0f}  \n" + 
-            f"Average distance: {avg_distance:.0f} km  \n" + 
-            f"Country Acc: {100*avg_country_accuracy:.1f}  \n" + 
-            f"Region Acc: {100*avg_region_accuracy:.1f}  \n" + 
-            f"Area Acc: {100*avg_area_accuracy:.1f}  \n" + 
-            f"City Acc: {100*avg_city_accuracy:.1f}"
+        # the levels the tally does not score (city and area with polygons) are left out rather than shown as 0
+        final_results = '  \n'.join(
+            [f"Average GeoScore: {avg_score:.0f}", f"Average distance: {avg_distance:.0f} km"] +
+            [f"{level.capitalize()} Acc: {100*accuracies[level]:.1f}" for level in reversed(ADMIN_LEVELS)
+             if level in self.tally.SCORED_LEVELS]
         )
 
         self.cache_final(final_results)
+        incr('games_finished')
 
         # Update the text box
         return f"# Your stats 🌍\n" + final_results + f"  \n# Thanks for playing ❤️"
         
-    # Function to save the game state
+    def summary_map(self):
+        # Every guess and true location of the game on one map, saved next to the results
+        path = summary_path(self.cache_path)
+        os.makedirs(self.cache_path, exist_ok=True)
+        n = len(self.stats['clicked_locations'])
+        click_lats, click_lons = np.array(self.stats['clicked_locations'], dtype=np.float64).reshape(-1, 2).T
+        true_lons, true_lats = self.dataset.coordinates[:n].T
+        with self.pool.checkout() as renderer:
+            return renderer.summary(path, click_lons, click_lats, true_lons, true_lats)
+
+    # Function to save the game state (queued, written in the background)
     def cache(self, index, score, distance, location, time_elapsed):
-        if not os.path.exists(self.cache_path):
-            os.makedirs(self.cache_path)
-
-        with open(join(self.cache_path, str(index).zfill(2) + '.txt'), 'w') as f:
-            print(f"{score}, {distance}, {location[0]}, {location[1]}, {time_elapsed}", file=f)
+        image_id = self.dataset.image_ids[index - 1].item()
+        self.results.click(os.path.basename(self.cache_path), index, image_id, score, distance, location, time_elapsed)
 
     # Function to save the game state
     def cache_final(self, final_results):
-        times = ', '.join(map(str, self.stats['times']))
-        with open(join(self.cache_path, 'full.txt'), 'w') as f:
-            print(f"{final_results}" + '\n Times: ' + times, file=f)
+        self.results.final(os.path.basename(self.cache_path), final_results, self.stats['times'])
+
+
+
+# The callbacks of the web page without Gradio, so scripts can drive them too (see loadtest.py)
+def start_game(state, profiled=False):
+    # create a unique random temporary name under CACHE_DIR
+    # generate random hex and make sure it doesn't exist under CACHE_DIR
+    while True:
+        path = str(uuid.uuid4().hex)
+        name = os.path.join(RESULTS_DIR, path)
+        if not os.path.exists(name):
+            break
+
+    # sampled stacks are kept under the session name until the game ends
+    state['profile'] = path if profiled and PROFILE_DIR is not None else None
+    incr('sessions_started')
+    with span('callback.start'), profile(state['profile']):
+        # the engine lives in the session manager, the page state only holds its name
+        state['session'] = path
+        get_sessions().add(path, Engine(IMAGE_FOLDER, CSV_FILE, name))
+        state['clicked'] = False
+        # bumped by every Next, so a map drawn for an image the player already left is dropped
+        state['generation'] = 0
+        with get_sessions().use(path) as engine:
+            return engine.load_image()
+
+def click_game(state, x, y):
+    # None if the player already clicked on this image
+    text = score_game(state, x, y)
+    if text is None:
+        return None
+    return render_game(state), text
+
+def score_game(state, x, y):
+    # The fast half of a click: score and text, the map is left to render_game.
+    # The requests of a session run one at a time (see SessionManager.use), so a quick Next
+    # never moves to the next image while this click is scored
+    with span('callback.click'), profile(state['profile']), get_sessions().use(state['session']) as engine:
+        if engine is None or state['clicked']:
+            return None
+        state['clicked'] = True
+        text, location = engine.score_click(x, y)
+        state['render'] = (state['generation'], location)
+    return text
+
+def render_game(state):
+    # None when there is no map to show anymore: the player moved on to the next image
+    generation, location = state.pop('render', (None, None))
+    if generation != state['generation']:
+        return None
+    # the map only needs the two locations: drawn alongside the player's other requests rather than after them
+    with span('callback.render'), profile(state['profile']), get_sessions().use(state['session'], exclusive=False) as engine:
+        if engine is None:
+            return None
+        fig = engine.render_click(*location)
+    return fig if generation == state['generation'] else None
+
+def next_game(state):
+    # None before the click, the final text after the last image, otherwise the next round
+    with span('callback.next'), profile(state['profile']), get_sessions().use(state['session']) as engine:
+        if engine is None or not state['clicked']:
+            return None
+        state['generation'] += 1
+        state.pop('render', None)
+        if engine.isfinal():
+            result = engine.finish()
+            state['summary'] = engine.summary_map()
+            if state['profile'] is not None:
+                # written before the session is removed, which drops its samples
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                get_profiler().write(state['profile'], os.path.join(PROFILE_DIR, state['profile'] + '.folded'))
+            get_sessions().remove(state['session'])
+            return result
+        state['clicked'] = False
+        return engine.next_image()
+
+
+# Sessions out of memory: in the SessionStore once idle, or between any two requests in multi-process mode,
+# where the Gradio process only dispatches and every request is served by whichever worker process is free
+
+def get_store():
+    global _store
+    if _store is None:
+        with _shared_lock:
+            if _store is None:
+                _store = SessionStore(SESSION_STORE)
+    return _store
+
+def get_sessions():
+    # Live sessions of this process, spilled to the store when idle
+    global _sessions
+    if _sessions is None:
+        with _shared_lock:
+            if _sessions is None:
+                _sessions = SessionManager(get_store(), Engine.to_state, engine_from_state, SESSION_TTL, MAX_SESSIONS,
+                                           SESSION_KEEP, forget=get_profiler().forget if PROFILE_DIR is not None else None)
+    return _sessions
+
+def session_gauges():
+    # Counted from the sessions held rather than up and down as games start and finish,
+    # so the abandoned, evicted and swept ones drop out of active_sessions
+    stats = get_sessions().stats()
+    stats['active_sessions'] = stats['live']
+    return stats
+
+def stored_session_gauges():
+    # with --workers every game in progress is in the store
+    return {'active_sessions': get_store().stats()['sessions']}
+
+def engine_from_state(session, state):
+    return Engine.from_state(state, IMAGE_FOLDER, CSV_FILE, os.path.join(RESULTS_DIR, session))
+
+def worker_settings():
+    # workers are spawned, not forked: the settings changed from the command line are handed over
+    settings = {name: value for name, value in globals().items()
+                if name.isupper() and isinstance(value, (str, int, float, type(None)))}
+    # a worker serves one request at a time
+    settings['RENDER_WORKERS'] = 1
+    return settings
+
+def init_worker(settings, metrics=False):
+    globals().update(settings)
+    if metrics:
+        enable()
+    warm_up()
+
+def worker_call(fn, *args):
+    # The result, and the stage timings and counters recorded meanwhile for the Gradio process to merge
+    result = fn(*args)
+    return result, drain() if enabled() else None
+
+def load_engine(session):
+    # None when the session is not in the store (expired, see SESSION_KEEP), as SessionManager.use
+    state = get_store().load(session)
+    if state is None:
+        return None
+    return engine_from_state(session, state)
+
+def worker_check_in(barrier):
+    # returns once every worker holds one of these tasks: each of them has started and warmed up
+    barrier.wait()
+    return os.getpid()
+
+def worker_start(session):
+    incr('sessions_started')
+    engine = Engine(IMAGE_FOLDER, CSV_FILE, os.path.join(RESULTS_DIR, session))
+    result = engine.load_image()
+    get_store().save(session, engine.to_state())
+    return result
+
+def worker_score(session, x, y):
+    engine = load_engine(session)
+    if engine is None:
+        return None
+    text, location = engine.score_click(x, y)
+    get_store().save(session, engine.to_state())
+    return text, location
+
+def worker_render(location):
+    # no session needed, the map only depends on the two locations
+    with get_pool().checkout() as renderer:
+        return renderer.click(*location)
+
+def worker_next(session):
+    engine = load_engine(session)
+    if engine is None:
+        return None
+    if engine.isfinal():
+        result = engine.finish()
+        engine.summary_map()
+        get_store().delete(session)
+        return result
+    result = engine.next_image()
+    get_store().save(session, engine.to_state())
+    return result
+
+
+class Dispatcher(object):
+    # Same callbacks as start_game, score_game, render_game and next_game, served by worker processes.
+    # The requests of a session are run one at a time, in the order they came
+    def __init__(self, workers):
+        self.workers = workers
+        # a lock per session with requests running or waiting, dropped with the last one
+        self.locks = {}
+        self.waiting = defaultdict(int)
+        self.last_expire = 0.
+        self.executor = self.spawn()
+
+    def spawn(self):
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_worker, initargs=(worker_settings(), enabled()))
+
+    def warm_up(self):
+        # Start every worker now rather than on the first requests, returns their number:
+        # the tasks wait for each other, so a worker done warming up cannot take them all
+        with multiprocessing.get_context('spawn').Manager() as manager:
+            barrier = manager.Barrier(self.workers)
+            futures = [self.executor.submit(worker_check_in, barrier) for _ in range(self.workers)]
+            return len({future.result() for future in futures})
+
+    async def run(self, fn, *args, retry=True):
+        # None when a worker died during a call that cannot be retried
+        executor = self.executor
+        loop = asyncio.get_running_loop()
+        try:
+            result, recorded = await loop.run_in_executor(executor, worker_call, fn, *args)
+        except BrokenProcessPool:
+            # a worker died: the sessions are in the store, start new workers and try again once,
+            # unless the call may have saved its round already (scoring it twice is worse than dropping it)
+            if self.executor is executor:
+                self.executor = self.spawn()
+            if not retry:
+                return None
+            result, recorded = await loop.run_in_executor(self.executor, worker_call, fn, *args)
+        if recorded is not None:
+            merge(recorded)
+        return result
+
+    async def run_session(self, session, fn, *args, retry=True):
+        lock = self.locks.get(session)
+        if lock is None:
+            lock = self.locks[session] = asyncio.Lock()
+        self.waiting[session] += 1
+        try:
+            async with lock:
+                return await self.run(fn, session, *args, retry=retry)
+        finally:
+            # abandoned sessions keep no lock behind
+            self.waiting[session] -= 1
+            if not self.waiting[session]:
+                del self.waiting[session]
+                del self.locks[session]
+
+    async def expire(self):
+        # the sessions of the players who never came back, deleted from the store now and then
+        now = time.monotonic()
+        if now - self.last_expire < SESSION_SWEEP:
+            return
+        self.last_expire = now
+        await run_async(get_store().expire, SESSION_KEEP)
+
+    async def start(self, state):
+        await self.expire()
+        state['session'] = uuid.uuid4().hex
+        state['clicked'] = False
+        state['generation'] = 0
+        return await self.run_session(state['session'], worker_start)
 
+    async def score(self, state, x, y):
+        if state['clicked']:
+            return None
+        state['clicked'] = True
+        # scored at most once: after a crash the player goes on with Next (None too for an expired session)
+        scored = await self.run_session(state['session'], worker_score, x, y, retry=False)
+        if scored is None:
+            return None
+        text, location = scored
+        state['render'] = (state['generation'], location)
+        return text
+
+    async def render(self, state):
+        generation, location = state.pop('render', (None, None))
+        if generation != state['generation']:
+            return None
+        fig = await self.run(worker_render, location)
+        return fig if generation == state['generation'] else None
+
+    async def next(self, state):
+        if not state['clicked']:
+            return None
+        state['generation'] += 1
+        state.pop('render', None)
+        # moved at most once: after a crash, Next is pressed again rather than an image skipped
+        result = await self.run_session(state['session'], worker_next, retry=False)
+        if result is None:
+            return None
+        if isinstance(result, str):
+            state['summary'] = summary_path(os.path.join(RESULTS_DIR, state['session']))
+        else:
+            state['clicked'] = False
+        return result
 
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Plonk web game')
+    parser.add_argument('--no_warmup', action='store_true', help='Start serving right away, the first players pay for the loading')
+    parser.add_argument('--metrics_port', type=int, required=False, help='Serve /metrics and /metrics.json on this local port', default=METRICS_PORT)
+    parser.add_argument('--metrics_dump', type=str, required=False, help='JSON file the metrics are periodically written to', default=METRICS_DUMP)
+    parser.add_argument('--profile_dir', type=str, required=False, help='Folder of the profiles of the sessions started with ?profile=1', default=PROFILE_DIR)
+    parser.add_argument('--concurrency', type=int, required=False, help='Events processed at the same time', default=QUEUE_CONCURRENCY)
+    parser.add_argument('--queue_size', type=int, required=False, help='Events waiting in the queue before new ones are refused', default=QUEUE_SIZE)
+    parser.add_argument('--workers', type=int, required=False, help='Worker processes serving the sessions (0: all in this process)', default=WORKERS)
+    parser.add_argument('--session_store', type=str, required=False, help='SQLite file the sessions are kept in with --workers', default=SESSION_STORE)
+    args = parser.parse_args()
+    PROFILE_DIR = args.profile_dir
+    SESSION_STORE = args.session_store
+    QUEUE_CONCURRENCY = args.concurrency
+    if args.metrics_port is not None or args.metrics_dump is not None:
+        # before the workers are started, they record their own stages
+        enable()
+    dispatcher = Dispatcher(args.workers) if args.workers > 0 else None
+
+    start = time.perf_counter()
     import gradio as gr
-    def click(state, evt: gr.SelectData):
-        if state['clicked']:
-            return gr.update(), gr.update()
+    print(f"Startup: gradio import {time.perf_counter() - start:.2f}s")
+    # Async handlers: the slow parts run on the callback threads while the event loop keeps
+    # serving other players, and a click shows its score before its map is drawn
+    async def click(state, evt: gr.SelectData):
         x, y = evt.index
-        state['clicked'] = True
-        image, text = state['engine'].click(x, y)
-        return gr.update(value=image), gr.update(value=text)
-
-    def next_(state):
-        if state['clicked']:
-            if state['engine'].isfinal():
-                text = state['engine'].finish()
-                return gr.update(visible=False), gr.update(visible=False), gr.update(visible=False), gr.update(value=text), gr.update(visible=False)
-            else:
-                fig, image, text = state['engine'].next_image()
-                state['clicked'] = False
-                return gr.update(value=fig), gr.update(value=image), gr.update(value=text), gr.update(), gr.update()
+        if dispatcher is not None:
+            text = await dispatcher.score(state, x, y)
+        else:
+            text = await run_async(score_game, state, x, y)
+        if text is None:
+            return gr.update()
+        return gr.update(value=text)
+
+    async def click_map(state):
+        if dispatcher is not None:
+            fig = await dispatcher.render(state)
+        else:
+            fig = await run_async(render_game, state)
+        if fig is None:
+            return gr.update()
+        return gr.update(value=fig)
+
+    async def next_(state):
+        if dispatcher is not None:
+            result = await dispatcher.next(state)
         else:
+            result = await run_async(next_game, state)
+        if result is None:
             return gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+        elif isinstance(result, str):
+            # the map stays, with every round of the game on it
+            return gr.update(value=state['summary'], label='Your game'), gr.update(visible=False), gr.update(visible=False), gr.update(value=result), gr.update(visible=False)
+        else:
+            fig, image, text = result
+            return gr.update(value=fig), gr.update(value=image), gr.update(value=text), gr.update(), gr.update()
 
-    def start(state):
-        # create a unique random temporary name under CACHE_DIR
-        # generate random hex and make sure it doesn't exist under CACHE_DIR
-        while True:
-            path = str(uuid.uuid4().hex)
-            name = os.path.join(RESULTS_DIR, path)
-            if not os.path.exists(name):
-                break
-
-        state['engine'] = Engine(IMAGE_FOLDER, CSV_FILE, name)
-        state['clicked'] = False
-        fig, image, text = state['engine'].load_image()
+    async def start(state, request: gr.Request):
+        # a player (or a developer) asks for a profile of their own session with ?profile=1
+        if dispatcher is not None:
+            fig, image, text = await dispatcher.start(state)
+        else:
+            fig, image, text = await run_async(start_game, state, request.query_params.get('profile') == '1')
 
         return (
             gr.update(value=fig, visible=True),
@@ -256,7 +770,25 @@ if __name__ == "__main__":
 
         next_button = gr.Button("Next", visible=False)
         start_button.click(start, inputs=[state], outputs=[map_, image_, text_count, text, next_button, rules, state, start_button])
-        map_.select(click, inputs=[state], outputs=[map_, text])
+        map_.select(click, inputs=[state], outputs=[text]).then(click_map, inputs=[state], outputs=[map_])
         next_button.click(next_, inputs=[state], outputs=[map_, image_, text_count, text, next_button])
 
+    if enabled():
+        add_collector(session_gauges if dispatcher is None else stored_session_gauges)
+    if args.metrics_port is not None:
+        serve(args.metrics_port)
+    if args.metrics_dump is not None:
+        dump_periodically(args.metrics_dump, METRICS_INTERVAL)
+
+    # Load the dataset and the geocoder and render the base map before accepting players
+    if args.no_warmup:
+        pass
+    elif dispatcher is not None:
+        # each worker warms itself up when it starts
+        start = time.perf_counter()
+        print(f"Startup: {dispatcher.warm_up()} workers {time.perf_counter() - start:.2f}s")
+    else:
+        for phase, elapsed in warm_up().items():
+            print(f"Startup: {phase} {elapsed:.2f}s")
+    demo.queue(concurrency_count=args.concurrency, max_size=args.queue_size)
     demo.launch(share=True, debug=True)
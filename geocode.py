@@ -0,0 +1,63 @@
+"""Reverse geocoding of the clicks, done as they happen instead of at the end of the game"""
+import threading
+from metrics import span
+from dataset import ADMIN_LEVELS
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+
+def get_geocoder():
+    # One geocoder per process, queried in-process (mode=1) rather than through a multiprocessing pool
+    global _geocoder
+    if _geocoder is None:
+        with _geocoder_lock:
+            if _geocoder is None:
+                import reverse_geocoder as rg
+                _geocoder = rg.RGeocoder(mode=1, verbose=False)
+    return _geocoder
+
+
+def warm(background=False):
+    # Load the places and build the KD-tree before the first player needs it
+    # (in the background, the first lookup waits for the end of the loading)
+    if background:
+        threading.Thread(target=get_geocoder, name='geocode-warm', daemon=True).start()
+        return None
+    return get_geocoder()
+
+
+def search(locations):
+    # locations: list of (lat, lon)
+    geocoder = get_geocoder()
+    with span('geocode.search'):
+        return geocoder.query([tuple(location) for location in locations])
+
+
+def admin_names(result):
+    return [result['name'], result['admin2'], result['admin1'], result['cc']]
+
+
+class AdminTally(object):
+    # Correct and valid counts per admin level (city, area, region, country), kept up to date click by click.
+    # A click is geocoded right away: a lookup in the loaded KD-tree takes microseconds,
+    # less than handing it to another thread
+    SCORED_LEVELS = ADMIN_LEVELS
+
+    def __init__(self):
+        self.correct = [0, 0, 0, 0]
+        self.valid = [0, 0, 0, 0]
+
+    def add(self, clicked_admin, true_admin):
+        for i in range(4):
+            if true_admin[i] != 'nan':
+                self.valid[i] += 1
+            if true_admin[i] == clicked_admin[i]:
+                self.correct[i] += 1
+
+    def submit(self, lat, lon, true_admin):
+        self.add(admin_names(search([(lat, lon)])[0]), true_admin)
+
+    def accuracies(self):
+        # city, area, region, country accuracy over the clicks so far
+        return [c / v if v else 0 for c, v in zip(self.correct, self.valid)]
@@ -0,0 +1,75 @@
+"""Round images, decoded ahead of time and shared by all sessions"""
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from metrics import span
+
+
+class ImageCache(object):
+    # Bounded LRU of decoded (and optionally downsized) round images.
+    # Every player sees the same images, so a single cache serves all the sessions of a process.
+    # Without an encoder the values are PIL images, with one they are whatever it returns
+    # (e.g. the path of a display-sized JPEG that Gradio can send as is).
+    def __init__(self, maxsize=16, max_size=None, encoder=None, workers=2):
+        self.maxsize = maxsize
+        self.max_size = max_size
+        self.encoder = encoder
+        self.images = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+
+    def load(self, path):
+        if self.encoder is not None and self.max_size is None:
+            # nothing to resize: the file on disk is already what should be sent
+            return path
+        with span('image.decode'):
+            pil = Image.open(path)
+            if self.max_size is not None:
+                # let the JPEG decoder downscale while decoding, then finish with a proper filter
+                pil.draft('RGB', self.max_size)
+                pil.thumbnail(self.max_size)
+            pil.load()
+        if self.encoder is None:
+            return pil
+        name = f"{os.path.splitext(os.path.basename(path))[0]}_{self.max_size[0]}x{self.max_size[1]}"
+        return self.encoder.write(self.encoder.encode(pil), name=name)
+
+    def put(self, path, image):
+        with self.lock:
+            self.images[path] = image
+            self.images.move_to_end(path)
+            while len(self.images) > self.maxsize:
+                self.images.popitem(last=False)
+
+    def get(self, path):
+        with self.lock:
+            image = self.images.get(path)
+            if image is not None:
+                self.images.move_to_end(path)
+                return image
+            future = self.pending.get(path)
+        if future is not None:
+            # already being decoded in the background
+            return future.result()
+        image = self.load(path)
+        self.put(path, image)
+        return image
+
+    def fetch(self, path):
+        try:
+            image = self.load(path)
+            self.put(path, image)
+            return image
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def prefetch(self, path):
+        # Decode an image the player is about to see while they are still guessing
+        with self.lock:
+            if path in self.images or path in self.pending:
+                return
+            self.pending[path] = self.executor.submit(self.fetch, path)
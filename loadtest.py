@@ -0,0 +1,141 @@
+"""Simulated players driving the game callbacks concurrently, without browser or network"""
+import os
+import gc
+import glob
+import json
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import game
+from game import start_game, click_game, next_game, warm_up
+from render import lonlat_to_pixels
+from dataset import load_dataset
+
+CALLBACKS = ('start', 'click', 'next')
+
+
+def current_rss():
+    # resident memory in bytes right now (not the peak)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def load_traces(results_dir):
+    # Games recorded by the server: lists of (lat, lon, seconds spent) in round order,
+    # from results/<uuid>/NN.txt folders and from the JSONL logs
+    traces = []
+    for session_dir in glob.glob(os.path.join(results_dir, '*', '')):
+        clicks = []
+        for path in sorted(glob.glob(os.path.join(session_dir, '[0-9]*.txt'))):
+            with open(path) as f:
+                _, _, lat, lon, time_elapsed = map(float, f.read().split(','))
+            clicks.append((lat, lon, time_elapsed))
+        if clicks:
+            traces.append(clicks)
+    sessions = defaultdict(list)
+    for path in glob.glob(os.path.join(results_dir, 'results-*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record['type'] == 'click':
+                    sessions[record['session']].append((record['index'], record['lat'], record['lon'], record['time']))
+    for clicks in sessions.values():
+        traces.append([click[1:] for click in sorted(clicks)])
+    return traces
+
+
+def synthetic_trace(rng, rounds, think):
+    return [(rng.uniform(-90, 90), rng.uniform(-180, 180), rng.uniform(0, 2 * think)) for _ in range(rounds)]
+
+
+class LoadTest(object):
+    def __init__(self, think_scale=0.):
+        self.think_scale = think_scale
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+        self.states = []
+
+    def timed(self, name, fn, *args):
+        start = time.perf_counter()
+        out = fn(*args)
+        with self.lock:
+            self.samples[name].append(time.perf_counter() - start)
+        return out
+
+    def play(self, trace):
+        state = {}
+        self.timed('start', start_game, state)
+        base = game.get_pool().base_map
+        for lat, lon, time_elapsed in trace:
+            if self.think_scale:
+                time.sleep(time_elapsed * self.think_scale)
+            x, y = lonlat_to_pixels(lon, lat, base.size, base.extent)
+            self.timed('click', click_game, state, float(x), float(y))
+            result = self.timed('next', next_game, state)
+            if isinstance(result, str):
+                break
+        with self.lock:
+            self.states.append(state)
+
+    def run(self, traces, concurrency):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(self.play, traces))
+
+    def report(self, elapsed):
+        calls = sum(len(values) for values in self.samples.values())
+        lines = [f"{len(self.states)} sessions, {calls} callbacks in {elapsed:.1f}s: {calls / elapsed:.1f} callbacks/s"]
+        for name in CALLBACKS:
+            values = np.array(self.samples.get(name, [0.]))
+            lines.append(f"{name:<6} p50 {1000*np.percentile(values, 50):8.2f} ms  p99 {1000*np.percentile(values, 99):8.2f} ms  "
+                         f"({len(self.samples.get(name, []))} calls)")
+        return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of the game callbacks')
+    parser.add_argument('--sessions', type=int, required=False, help='Number of simulated players', default=20)
+    parser.add_argument('--concurrency', type=int, required=False, help='Players playing at the same time', default=8)
+    parser.add_argument('--traces', type=str, required=False, help='Results folder with recorded games to replay (default: random clicks)', default=None)
+    parser.add_argument('--think_scale', type=float, required=False, help='Fraction of the recorded thinking time waited before each click', default=0.)
+    parser.add_argument('--abandon', type=float, required=False, help='Fraction of the players leaving before the end of their game', default=0.)
+    parser.add_argument('--seed', type=int, required=False, help='Seed of the synthetic games', default=0)
+
+    args = parser.parse_args()
+
+    # results of the simulated players do not go with the real ones
+    game.RESULTS_DIR = os.path.join(game.RESULTS_DIR, 'loadtest')
+    game.RESULTS_BACKEND = 'jsonl'
+    game.RESULTS_DURABILITY = 'none'
+    game.SESSION_STORE = os.path.join(game.RESULTS_DIR, 'sessions.db')
+    warm_up()
+
+    rng = random.Random(args.seed)
+    recorded = load_traces(args.traces) if args.traces else []
+    if args.traces and not recorded:
+        print(f"No recorded games in {args.traces}, using random clicks")
+    rounds = len(load_dataset(game.CSV_FILE, game.DATASET_CACHE))
+    traces = [recorded[i % len(recorded)] if recorded else synthetic_trace(rng, rounds, 5.)
+              for i in range(args.sessions)]
+    # abandoned tabs: games stopped after a random number of rounds
+    traces = [trace[:rng.randrange(len(trace))] if rng.random() < args.abandon else trace for trace in traces]
+
+    gc.collect()
+    rss_before = current_rss()
+    load_test = LoadTest(args.think_scale)
+    start = time.perf_counter()
+    load_test.run(traces, args.concurrency)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    rss_after = current_rss()
+
+    for line in load_test.report(elapsed):
+        print(line)
+    print(f"memory: {(rss_after - rss_before) / 2**20:.1f} MB more resident, "
+          f"{(rss_after - rss_before) / max(len(load_test.states), 1) / 1024:.1f} KB per session")
+    stats = game.get_sessions().stats()
+    print(f"sessions: {stats['live']} live holding {stats['live_bytes'] / 1024:.1f} KB "
+          f"(largest {stats['max_session_bytes'] / 1024:.1f} KB), {stats['spilled']} spilled to disk")
@@ -0,0 +1,278 @@
+"""Stage timings, session counters and an opt-in sampling profiler for the game server.
+Nothing is recorded until enable() is called: a disabled span costs one function call"""
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict, Counter
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+PREFIX = 'plonk'
+COUNTERS = ('sessions_started', 'rounds_served', 'games_finished', 'maps_encoded', 'map_bytes')
+
+_enabled = False
+_lock = threading.Lock()
+_NULL = nullcontext()
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+_stages = defaultdict(Histogram)
+_counters = Counter()
+_collectors = []
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def observe(stage, elapsed):
+    with _lock:
+        _stages[stage].observe(elapsed)
+
+
+class Span(object):
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def span(stage):
+    # with span('click.encode'): ...
+    return Span(stage) if _enabled else _NULL
+
+
+def incr(name, value=1):
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+
+
+def add_collector(fn):
+    # fn() -> {name: value}, the gauges: read when a snapshot is taken rather than updated as they change
+    _collectors.append(fn)
+
+
+def snapshot():
+    collected = {}
+    for fn in _collectors:
+        collected.update(fn())
+    with _lock:
+        return {
+            'time': time.time(),
+            'stages': {stage: {'count': h.count, 'sum': h.sum, 'buckets': list(h.counts)} for stage, h in _stages.items()},
+            'counters': {name: _counters[name] for name in set(COUNTERS) | set(_counters)},
+            'gauges': collected,
+        }
+
+
+def drain():
+    # The stages and counters recorded since the last call, then reset:
+    # a worker process hands them over with each result, see merge
+    with _lock:
+        data = {
+            'stages': {stage: (h.counts, h.count, h.sum) for stage, h in _stages.items()},
+            'counters': dict(_counters),
+        }
+        _stages.clear()
+        _counters.clear()
+    return data
+
+
+def merge(data):
+    # adds what another process drained
+    with _lock:
+        for stage, (counts, count, total) in data['stages'].items():
+            h = _stages[stage]
+            h.counts = [a + b for a, b in zip(h.counts, counts)]
+            h.count += count
+            h.sum += total
+        _counters.update(data['counters'])
+
+
+def prometheus_text():
+    # Text exposition format, as scraped by Prometheus
+    data = snapshot()
+    lines = [f"# TYPE {PREFIX}_stage_seconds histogram"]
+    for stage, h in sorted(data['stages'].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), h['buckets']):
+            cumulative += count
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {h["sum"]}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {h["count"]}')
+    for name, value in sorted(data['counters'].items()):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        lines.append(f"{PREFIX}_{name}_total {value}")
+    for name, value in sorted(data['gauges'].items()):
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        lines.append(f"{PREFIX}_{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='127.0.0.1'):
+    # /metrics in the Prometheus format, /metrics.json as a snapshot, from a daemon thread
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = prometheus_text().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(snapshot()).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def dump(path):
+    # written next to the target and renamed, so readers never see half a file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+
+
+def dump_periodically(path, interval=10.):
+    def run():
+        while True:
+            time.sleep(interval)
+            # a failed dump (a collector raising, a full disk) does not stop the next ones
+            try:
+                dump(path)
+            except Exception:
+                traceback.print_exc()
+
+    thread = threading.Thread(target=run, name='metrics-dump', daemon=True)
+    thread.start()
+    return thread
+
+
+class SamplingProfiler(object):
+    # Samples the stacks of the threads serving the profiled sessions every interval seconds.
+    # Stacks are kept in the collapsed format of flamegraph.pl / speedscope: "a;b;c count"
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.threads = {}
+        self.stacks = defaultdict(Counter)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @contextmanager
+    def attach(self, session):
+        # everything the current thread does inside the block is sampled for this session
+        thread_id = threading.get_ident()
+        with self.lock:
+            self.threads[thread_id] = session
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+                self.thread.start()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            with self.lock:
+                threads = dict(self.threads)
+            if not threads:
+                # stops when nothing is attached, attach() starts it again
+                with self.lock:
+                    if not self.threads:
+                        self.thread = None
+                        return
+                continue
+            frames = sys._current_frames()
+            for thread_id, session in threads.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    key = ';'.join(reversed(stack))
+                    with self.lock:
+                        self.stacks[session][key] += 1
+            time.sleep(self.interval)
+
+    def forget(self, session):
+        # a session that will not finish here (abandoned, or moved out of memory) leaves no samples behind
+        with self.lock:
+            self.stacks.pop(session, None)
+
+    def write(self, session, path):
+        # Writes and forgets the samples of a session, returns the number of samples
+        with self.lock:
+            stacks = self.stacks.pop(session, Counter())
+        with open(path, 'w') as f:
+            for key, count in stacks.most_common():
+                f.write(f"{key} {count}\n")
+        return sum(stacks.values())
+
+
+_profiler = None
+
+
+def get_profiler():
+    global _profiler
+    if _profiler is None:
+        with _lock:
+            if _profiler is None:
+                _profiler = SamplingProfiler()
+    return _profiler
+
+
+def profile(session):
+    # Only the sessions that opted in pay for sampling
+    return get_profiler().attach(session) if session is not None else _NULL
@@ -0,0 +1,82 @@
+"""Coastlines and borders kept as plain arrays next to the code, so maps are drawn without
+fetching or parsing Natural Earth shapefiles: python natural_earth.py builds the bundle once"""
+import os
+import argparse
+import numpy as np
+
+BUNDLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'natural_earth.npz')
+SCALE = '110m'
+# the features cfeature.COASTLINE and cfeature.BORDERS draw on a world map
+FEATURES = {
+    'coastline': ('physical', 'coastline'),
+    'borders': ('cultural', 'admin_0_boundary_lines_land'),
+}
+
+_bundle = None
+
+
+def iter_lines(geometry):
+    if geometry.geom_type == 'LineString':
+        yield geometry.coords
+    elif geometry.geom_type == 'Polygon':
+        yield geometry.exterior.coords
+        for interior in geometry.interiors:
+            yield interior.coords
+    elif hasattr(geometry, 'geoms'):
+        for part in geometry.geoms:
+            yield from iter_lines(part)
+
+
+def build(path=BUNDLE_FILE, scale=SCALE, source_dir=None):
+    # Reads the shapefiles through cartopy (downloaded once if needed), or from source_dir
+    # when they were copied there by hand (e.g. ne_110m_coastline.shp) on a host without network.
+    # PlateCarree coordinates are plain degrees, so the stored lines are already projected
+    import cartopy.io.shapereader as shpreader
+
+    arrays = {}
+    for name, (category, feature) in FEATURES.items():
+        if source_dir is not None:
+            shapefile = os.path.join(source_dir, f"ne_{scale}_{feature}.shp")
+        else:
+            shapefile = shpreader.natural_earth(resolution=scale, category=category, name=feature)
+        lines = [np.asarray(coords, dtype=np.float32)[:, :2]
+                 for geometry in shpreader.Reader(shapefile).geometries() for coords in iter_lines(geometry)]
+        arrays[name + '_coords'] = np.concatenate(lines)
+        arrays[name + '_offsets'] = np.cumsum([0] + [len(line) for line in lines]).astype(np.int32)
+    np.savez(path, **arrays)
+    return path
+
+
+def load(path=BUNDLE_FILE):
+    # name -> list of (n, 2) lon/lat arrays, or None when no bundle was built
+    global _bundle
+    if _bundle is None:
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            _bundle = {name: np.split(data[name + '_coords'], data[name + '_offsets'][1:-1]) for name in FEATURES}
+    return _bundle
+
+
+def add_features(ax):
+    # Same as ax.add_feature(cfeature.COASTLINE) and ax.add_feature(cfeature.BORDERS, linestyle=':')
+    # on a PlateCarree map, from the bundle when there is one
+    bundle = load()
+    if bundle is None:
+        import cartopy.feature as cfeature
+        ax.add_feature(cfeature.COASTLINE)
+        ax.add_feature(cfeature.BORDERS, linestyle=':')
+        return
+    from matplotlib.collections import LineCollection
+    ax.add_collection(LineCollection(bundle['coastline'], colors='black', linewidths=1.0, transform=ax.transData), autolim=False)
+    ax.add_collection(LineCollection(bundle['borders'], colors='black', linewidths=1.0, linestyles=':', transform=ax.transData), autolim=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the local coastline and border bundle')
+    parser.add_argument('--output', type=str, required=False, help='Bundle file', default=BUNDLE_FILE)
+    parser.add_argument('--scale', type=str, required=False, help='Natural Earth scale', default=SCALE)
+    parser.add_argument('--source_dir', type=str, required=False, help='Folder with the Natural Earth shapefiles (default: fetched by cartopy)', default=None)
+
+    args = parser.parse_args()
+    print(build(args.output, args.scale, args.source_dir))
@@ -2,16 +2,31 @@ import os
 import tkinter as tk
 import pandas as pd
 from tkinter import messagebox
-from PIL import Image, ImageTk
-import reverse_geocoder as rg
+from PIL import ImageTk
 import cartopy.crs as ccrs
 import cartopy.geodesic as cgeo
-import cartopy.feature as cfeature
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from natural_earth import add_features
 from math import radians, sin, cos, sqrt, asin, exp
 import argparse
 import pickle
+import struct
+import zlib
+from images import ImageCache
+from derivatives import Derivatives
+from geocode import AdminTally, warm
+from admin_polygons import PolygonTally, admin_codes
+from render import great_circle
+from dataset import ADMIN_LEVELS
+
+STATE_FILE = 'game_state.pkl'
+JOURNAL_FILE = 'game_state.journal'
+# one fixed-size record per click: index, lat, lon, score, distance, then a CRC32 of those
+RECORD = struct.Struct('<Idddd')
+CRC = struct.Struct('<I')
+RECORD_SIZE = RECORD.size + CRC.size
 
 def haversine(lat1, lon1, lat2, lon2):
     if (lat1 is None) or (lon1 is None) or (lat2 is None) or (lon2 is None):
@@ -32,14 +47,64 @@ def geoscore(d):
 
 
 
+class GameJournal:
+    # Append-only journal of the clicks, replayed to resume a game.
+    # Saving is O(1) per click, and a record torn by a crash is dropped on replay
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.file = None
+
+    def append(self, index, lat, lon, score, distance):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        body = RECORD.pack(index, lat, lon, score, distance)
+        self.file.write(body + CRC.pack(zlib.crc32(body)))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def replay(self):
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        end = 0
+        while end + RECORD_SIZE <= len(data):
+            body = data[end:end + RECORD.size]
+            if CRC.unpack_from(data, end + RECORD.size)[0] != zlib.crc32(body):
+                break
+            records.append(RECORD.unpack(body))
+            end += RECORD_SIZE
+        if end < len(data):
+            # drop the torn tail so the next records are appended at a record boundary
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        return records
+
+
 class ImageSorter:
     def __init__(self, args, master, images, coordinates, admins):
         self.master = master
         self.images = images
         self.coordinates = coordinates
         self.admins = admins
+        if args.admin_scoring == 'polygons':
+            # clicks are compared with the country and region polygons of the true locations, looked up at once
+            lons, lats = zip(*coordinates)
+            self.admins = admin_codes(lons, lats)
         self.source_folder = args.image_folder
+        # display-sized copies built by derivatives.py, used when there is one for the image
+        self.derivatives = Derivatives(args.derivatives) if args.derivatives else None
+        self.display_width = args.image_size or 960
+        self.journal = GameJournal(JOURNAL_FILE, fsync=args.fsync)
         self.index = 0     
+
+        # Images are decoded in the background while the player is guessing
+        image_size = (args.image_size, args.image_size) if args.image_size else None
+        self.image_cache = ImageCache(maxsize=args.prefetch + 2, max_size=image_size)
+        self.prefetch = args.prefetch
           
         # Initialize the score and distance lists
         self.scores = []
@@ -77,8 +142,21 @@ class ImageSorter:
         # Textbox for distance display
         self.canvas_widget = self.canvas.get_tk_widget()
         self.canvas_widget.pack()
+
+        # The map is drawn once: each round only restores its pixels and blits the markers on top
+        self.ax.set_global()
+        self.ax.stock_img()
+        add_features(self.ax)
+        self.true_marker, = self.ax.plot([], [], 'ro', animated=True)
+        self.line, = self.ax.plot([], [], color='blue', linewidth=2, animated=True)
+        self.background = None
+        # a full redraw (first show, resize) invalidates the saved pixels
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        # a single click handler for the whole game, clicks after the first of a round are ignored
+        self.clicked = False
+        self.canvas.mpl_connect('button_press_event', self.on_map_click)
         
-        #laod pickle - if it exists
+        #load the saved game - if it exists
         state = self.load_game_state()
         if state is not None:
             self.index = state['index']
@@ -91,6 +169,16 @@ class ImageSorter:
             self.distances = []
             self.clicked_locations = []
 
+        # Clicks are geocoded as they happen, the resumed ones right now.
+        # The geocoder loads in the background, the first lookup waits for it
+        if args.admin_scoring == 'polygons':
+            self.tally = PolygonTally()
+        else:
+            warm(background=True)
+            self.tally = AdminTally()
+        for index, (lat, lon) in enumerate(self.clicked_locations):
+            self.tally.submit(lat, lon, self.admins[index])
+
         # Load initial image
         self.load_image()
      
@@ -103,36 +191,57 @@ class ImageSorter:
             self.finish()
             
             self.master.bind('<space>', lambda event: self.exit_application())
+            return
 
 
-        image_path = os.path.join(self.source_folder, f"{self.images[self.index]}.jpg")
-        pil_image = Image.open(image_path)
+        pil_image = self.image_cache.get(self.image_path(self.index))
         self.tk_image = ImageTk.PhotoImage(pil_image)
         self.label.config(image=self.tk_image)
+        for index in range(self.index + 1, min(self.index + 1 + self.prefetch, len(self.images))):
+            self.image_cache.prefetch(self.image_path(index))
 
-        # Clear the canvas and create a new map
-        self.ax.clear()
-        self.ax.set_global()
-        self.ax.stock_img()
-        self.ax.add_feature(cfeature.COASTLINE)
-        self.ax.add_feature(cfeature.BORDERS, linestyle=':')
+        # Back to the bare map
+        self.true_marker.set_data([], [])
+        self.line.set_data([], [])
+        self.clicked = False
         
         self.result_text_widget.delete('1.0', tk.END)
         self.result_text_widget.insert('end', f"Image {self.index}/{len(self.images)}\nClick the map")
                
-        self.canvas.draw()
-        
-        self.canvas.mpl_connect('button_press_event', self.on_map_click)
+        self.blit()
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_markers()
+
+    def draw_markers(self):
+        self.ax.draw_artist(self.line)
+        self.ax.draw_artist(self.true_marker)
+
+    def blit(self):
+        # Only the markers are drawn, over the saved pixels of the map
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_markers()
+        self.canvas.blit(self.fig.bbox)
         
+    def image_path(self, index):
+        if self.derivatives is not None:
+            path = self.derivatives.path(self.images[index], self.display_width)
+            if path is not None:
+                return path
+        return os.path.join(self.source_folder, f"{self.images[index]}.jpg")
+
     def on_map_click(self, event):
-        if event.inaxes:  # Check if click was inside the axes
+        if event.inaxes and not self.clicked:  # Check if click was inside the axes
             click_lon, click_lat = event.xdata, event.ydata
+            # Ignore the next clicks until the next image
+            self.clicked = True
                         
             # Display true location and line
             self.display_true_location_and_line(click_lon, click_lat)
-
-            # Unbind the map click event to avoid multiple clicks
-            self.canvas.mpl_disconnect(self.canvas.mpl_connect('button_press_event', self.on_map_click))
         
         
     def display_true_location_and_line(self, click_lon, click_lat):
@@ -141,14 +250,15 @@ class ImageSorter:
         self.clicked_locations.append((click_lat,click_lon))
     
         true_lon, true_lat = self.coordinates[self.index]
-        self.ax.plot(true_lon, true_lat, 'ro', transform=ccrs.Geodetic())
+        self.tally.submit(click_lat, click_lon, self.admins[self.index])
+        self.true_marker.set_data([true_lon], [true_lat])
         
-        # Draw geodesic line immediately
-        self.ax.plot([true_lon, click_lon], [true_lat, click_lat], 
-                    color='blue', linewidth=2, 
-                    transform=ccrs.Geodetic())
+        # Draw geodesic line immediately, broken where it crosses the map edge
+        lons, lats = great_circle(true_lon, true_lat, click_lon, click_lat)
+        breaks = np.nonzero(np.abs(np.diff(lons)) > 180)[0] + 1
+        self.line.set_data(np.insert(lons, breaks, np.nan), np.insert(lats, breaks, np.nan))
         
-        self.canvas.draw()
+        self.blit()
         
       
         distance = haversine(true_lat, true_lon, click_lat, click_lon)
@@ -165,7 +275,7 @@ class ImageSorter:
                        "Press space")
         self.result_text_widget.insert('end', result_text)
         
-        self.save_game_state(self.index+1, self.scores, self.distances, self.clicked_locations)
+        self.save_game_state(self.index, click_lat, click_lon, score, distance)
 
         self.master.bind('<space>', self.on_key_press)  
     
@@ -177,9 +287,6 @@ class ImageSorter:
         # Go to the next image
         self.index = (self.index + 1)
         self.load_image()
-        
-        # Re-bind the map click event for the new image
-        self.canvas.mpl_connect('button_press_event', self.on_map_click)
 
         # Unbind key press to avoid skipping images accidentally
         self.master.unbind('<KeyPress>')
@@ -189,65 +296,59 @@ class ImageSorter:
         # Calculate the average values
         avg_score = sum(self.scores) / len(self.scores) if self.scores else 0
         avg_distance = sum(self.distances) / len(self.distances) if self.distances else 0
+        # Admin accuracies over the clicks played so far
+        _, _, avg_region_accuracy, avg_country_accuracy = self.tally.accuracies()
 
         # Update the text box
         self.average_text_widget.delete('1.0', tk.END)
         self.average_text_widget.insert('end', f"Average GeoScore: {avg_score:.0f}, "
-                                               f"Average distance: {avg_distance:.0f} km\n")
+                                               f"Average distance: {avg_distance:.0f} km\n"
+                                               f"Country Acc: {100*avg_country_accuracy:.1f}, "
+                                               f"Region Acc: {100*avg_region_accuracy:.1f}\n")
     
     def finish(self):
         
-        clicks = rg.search(self.clicked_locations)
-        clicked_admins = [[click['name'], click['admin2'], click['admin1'], click['cc']] for click in clicks]
-        
-        correct = [0,0,0,0]
-        valid = [0,0,0,0]
-        
-        for clicked_admin, true_admin in zip(clicked_admins, self.admins):
-            for i in range(4):
-                if true_admin[i]!= 'nan':
-                    valid[i] += 1
-                if true_admin[i] == clicked_admin[i]:
-                    correct[i] += 1
-                    
-        avg_city_accuracy = correct[0] / valid[0]
-        avg_area_accuracy = correct[1] / valid[1]
-        avg_region_accuracy = correct[2] / valid[2]
-        avg_country_accuracy = correct[3] / valid[3]
+        # The clicks were geocoded as they came
+        accuracies = dict(zip(ADMIN_LEVELS, self.tally.accuracies()))
         
         avg_score = sum(self.scores) / len(self.scores) if self.scores else 0
         avg_distance = sum(self.distances) / len(self.distances) if self.distances else 0
         
          # Update the text box
         self.average_text_widget.delete('1.0', tk.END)
-        exit_message = (f"Average GeoScore: {avg_score:.0f}, "
-                                               f"Average distance: {avg_distance:.0f} km, "
-                                               f"Country Acc: {100*avg_country_accuracy:.1f}, "
-                                               f"Region Acc: {100*avg_region_accuracy:.1f}, "
-                                               f"Area Acc: {100*avg_area_accuracy:.1f}, "
-                                               f"City Acc: {100*avg_city_accuracy:.1f}\n"
-                                               f"Please copy and paste this line to Loic :)\n"
+        # the levels the tally does not score (city and area with polygons) are left out rather than shown as 0
+        exit_message = (', '.join([f"Average GeoScore: {avg_score:.0f}", f"Average distance: {avg_distance:.0f} km"] +
+                                  [f"{level.capitalize()} Acc: {100*accuracies[level]:.1f}" for level in reversed(ADMIN_LEVELS)
+                                   if level in self.tally.SCORED_LEVELS]) + "\n"
+                                               "Please copy and paste this line to Loic :)\n"
                                                "Press space to exit")
         self.average_text_widget.insert('end', exit_message)
         
         print(exit_message)
         
-    # Function to save the game state
-    def save_game_state(self, index, scores, distances, clicked_locations):
-        with open('game_state.pkl', 'wb') as f:
-            pickle.dump({
-                'index': index,
-                'scores': scores,
-                'distances': distances,
-                'clicked_locations': clicked_locations
-            }, f)
+    # Function to save the game state: one journal record per click
+    def save_game_state(self, index, lat, lon, score, distance):
+        self.journal.append(index, lat, lon, score, distance)
 
     # Function to load the game state
     def load_game_state(self):
-        if os.path.exists('game_state.pkl'):
-            with open('game_state.pkl', 'rb') as f:
-                return pickle.load(f)
-        return None  # Return None or default values if the file does not exist
+        if not os.path.exists(JOURNAL_FILE) and os.path.exists(STATE_FILE):
+            # game saved by an older version: move it to the journal
+            with open(STATE_FILE, 'rb') as f:
+                state = pickle.load(f)
+            first = state['index'] - len(state['scores'])
+            for i, ((lat, lon), score, distance) in enumerate(zip(state['clicked_locations'], state['scores'], state['distances'])):
+                self.journal.append(first + i, lat, lon, score, distance)
+
+        records = self.journal.replay()
+        if not records:
+            return None  # Return None or default values if there is no saved game
+        return {
+            'index': records[-1][0] + 1,
+            'scores': [record[3] for record in records],
+            'distances': [record[4] for record in records],
+            'clicked_locations': [(record[1], record[2]) for record in records]
+        }
     
         
     def exit_application(self):
@@ -272,6 +373,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Image Viewer with Map')
     parser.add_argument('--image_folder', type=str, required=False, help='Folder with images', default='./select')
     parser.add_argument('--csv_file', type=str, required=False, help='CSV file with image ids and coordinates', default='./select.csv')
+    parser.add_argument('--image_size', type=int, required=False, help='Downsize images to fit this many pixels (0: full resolution)', default=0)
+    parser.add_argument('--derivatives', type=str, required=False, help='Folder of display-sized images built by derivatives.py', default=None)
+    parser.add_argument('--admin_scoring', type=str, required=False, help='geocoder: nearest place vs the CSV columns, polygons: country and region polygons (see admin_polygons.py)', default='geocoder')
+    parser.add_argument('--fsync', action='store_true', help='Force every saved click to disk')
+    parser.add_argument('--prefetch', type=int, required=False, help='Number of upcoming images decoded in the background', default=2)
 
     args = parser.parse_args()
        
@@ -0,0 +1,311 @@
+"""Map rendering shared by all game sessions"""
+import io
+import os
+import time
+import uuid
+import tempfile
+import queue
+import threading
+from contextlib import contextmanager
+from collections import namedtuple, deque
+import numpy as np
+from PIL import Image, ImageDraw
+from metrics import span, enabled, observe, incr
+
+FIGSIZE = (10, 6)
+DPI = 300
+EXTENT = (-180.0, 180.0, -90.0, 90.0)
+GUESS_COLOR = (0, 0, 255)
+TRUE_COLOR = (255, 0, 0)
+LINE_COLOR = (0, 0, 255)
+FORMATS = {'png': 'PNG', 'jpeg': 'JPEG', 'webp': 'WEBP'}
+OUTPUTS = ('pil', 'path')
+
+
+class BaseMap(namedtuple('BaseMap', ['png', 'pixels', 'mode', 'size', 'extent', 'dpi'])):
+    # png and pixels are bytes, so a cached base map can be shared by every session
+
+    def image(self):
+        # a fresh PIL image, safe to draw on
+        return Image.frombytes(self.mode, self.size, self.pixels)
+
+
+_base_maps = {}
+_base_maps_lock = threading.Lock()
+
+
+def render_base_map(figsize=FIGSIZE, dpi=DPI, extent=EXTENT):
+    # matplotlib and cartopy are only imported when a base map is actually rendered
+    import matplotlib
+    matplotlib.use('Agg')
+    import cartopy.crs as ccrs
+    import matplotlib.pyplot as plt
+    from natural_earth import add_features
+
+    fig = plt.Figure(figsize=figsize)
+    ax = fig.add_subplot(1, 1, 1, projection=ccrs.PlateCarree())
+    # PlateCarree coordinates are degrees, so the extent is also the axes limits
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    with span('base_map.stock_img'):
+        ax.stock_img()
+    with span('base_map.features'):
+        add_features(ax)
+
+    if enabled():
+        # savefig draws the figure again, this only splits drawing from PNG writing in the timings
+        with span('base_map.canvas_draw'):
+            fig.canvas.draw()
+    img_buf = io.BytesIO()
+    with span('base_map.savefig'):
+        fig.savefig(img_buf, format='png', bbox_inches='tight', pad_inches=0, dpi=dpi)
+    with span('base_map.decode'):
+        pil = Image.open(img_buf)
+        pil.load()
+    return BaseMap(img_buf.getvalue(), pil.tobytes(), pil.mode, pil.size, tuple(extent), dpi)
+
+
+def get_base_map(figsize=FIGSIZE, dpi=DPI, extent=EXTENT):
+    # the background never changes: render it once per process and per setting
+    key = (tuple(figsize), dpi, tuple(extent))
+    base = _base_maps.get(key)
+    if base is None:
+        with _base_maps_lock:
+            base = _base_maps.get(key)
+            if base is None:
+                base = render_base_map(figsize, dpi, extent)
+                _base_maps[key] = base
+    return base
+
+
+def great_circle(lon1, lat1, lon2, lat2, n=100):
+    # Sample n points along the great circle between the two locations (slerp on the unit sphere).
+    # Inputs can be arrays of m pairs, the output is then two (m, n) arrays of lon, lat in degrees
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lon1, lat1, lon2, lat2))
+    p1 = np.stack([np.cos(lat1) * np.cos(lon1), np.cos(lat1) * np.sin(lon1), np.sin(lat1)], axis=-1)
+    p2 = np.stack([np.cos(lat2) * np.cos(lon2), np.cos(lat2) * np.sin(lon2), np.sin(lat2)], axis=-1)
+    omega = np.arccos(np.clip(np.sum(p1 * p2, axis=-1), -1, 1))[..., None, None]
+    t = np.linspace(0, 1, n)[:, None]
+    sin_omega = np.sin(omega)
+    # identical or antipodal points: any path is as good as the straight one
+    degenerate = sin_omega < 1e-12
+    sin_omega = np.where(degenerate, 1, sin_omega)
+    slerp = (np.sin((1 - t) * omega) * p1[..., None, :] + np.sin(t * omega) * p2[..., None, :]) / sin_omega
+    lerp = (1 - t) * p1[..., None, :] + t * p2[..., None, :]
+    points = np.where(degenerate, lerp, slerp)
+    lons = np.degrees(np.arctan2(points[..., 1], points[..., 0]))
+    lats = np.degrees(np.arctan2(points[..., 2], np.hypot(points[..., 0], points[..., 1])))
+    return lons, lats
+
+
+def lonlat_to_pixels(lon, lat, size, extent):
+    # Inverse of Engine.normalize_pixels
+    width, height = size
+    min_lon, max_lon, min_lat, max_lat = extent
+    x = (np.asarray(lon) - min_lon) * width / (max_lon - min_lon)
+    y = height + 1 - (np.asarray(lat) - min_lat) * height / (max_lat - min_lat)
+    return x, y
+
+
+def split_at_dateline(lons, lats):
+    # Break a path where it wraps around the map edge
+    breaks = np.nonzero(np.abs(np.diff(lons)) > 180)[0] + 1
+    return zip(np.split(lons, breaks), np.split(lats, breaks))
+
+
+def draw_click_overlay(base, click_lon, click_lat, true_lon, true_lat):
+    # Same markers as the matplotlib version ('bo', blue line, 'rx'), sized in points
+    pil = base.image()
+    draw = ImageDraw.Draw(pil)
+    pt = base.dpi / 72
+    line_width = max(1, round(pt))
+    radius = 3 * pt
+
+    lons, lats = great_circle(true_lon, true_lat, click_lon, click_lat)
+    for seg_lons, seg_lats in split_at_dateline(lons, lats):
+        if len(seg_lons) > 1:
+            xs, ys = lonlat_to_pixels(seg_lons, seg_lats, base.size, base.extent)
+            draw.line(list(zip(xs.tolist(), ys.tolist())), fill=LINE_COLOR, width=line_width, joint='curve')
+
+    x, y = lonlat_to_pixels(click_lon, click_lat, base.size, base.extent)
+    draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=GUESS_COLOR)
+
+    x, y = lonlat_to_pixels(true_lon, true_lat, base.size, base.extent)
+    draw.line([(x - radius, y - radius), (x + radius, y + radius)], fill=TRUE_COLOR, width=line_width)
+    draw.line([(x - radius, y + radius), (x + radius, y - radius)], fill=TRUE_COLOR, width=line_width)
+    return pil
+
+
+def draw_summary_overlay(base, click_lons, click_lats, true_lons, true_lats):
+    # Every round of a game on one map: all the great circles are sampled in a single call,
+    # projected to pixels at once, then drawn with the markers of draw_click_overlay
+    pil = base.image()
+    draw = ImageDraw.Draw(pil)
+    pt = base.dpi / 72
+    line_width = max(1, round(pt))
+    radius = 3 * pt
+
+    lons, lats = great_circle(true_lons, true_lats, click_lons, click_lats)
+    xs, ys = lonlat_to_pixels(lons, lats, base.size, base.extent)
+    breaks = np.abs(np.diff(lons, axis=1)) > 180
+    for row_xs, row_ys, row_breaks in zip(xs.tolist(), ys.tolist(), breaks):
+        start = 0
+        for end in np.nonzero(row_breaks)[0].tolist() + [len(row_xs) - 1]:
+            if end > start:
+                draw.line(list(zip(row_xs[start:end + 1], row_ys[start:end + 1])), fill=LINE_COLOR, width=line_width, joint='curve')
+            start = end + 1
+
+    xs, ys = lonlat_to_pixels(click_lons, click_lats, base.size, base.extent)
+    for x, y in zip(np.atleast_1d(xs).tolist(), np.atleast_1d(ys).tolist()):
+        draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=GUESS_COLOR)
+
+    xs, ys = lonlat_to_pixels(true_lons, true_lats, base.size, base.extent)
+    for x, y in zip(np.atleast_1d(xs).tolist(), np.atleast_1d(ys).tolist()):
+        draw.line([(x - radius, y - radius), (x + radius, y + radius)], fill=TRUE_COLOR, width=line_width)
+        draw.line([(x - radius, y + radius), (x + radius, y - radius)], fill=TRUE_COLOR, width=line_width)
+    return pil
+
+
+class MapEncoder(object):
+    # Encodes map images once, in the configured format.
+    # output='pil' hands the PIL image over (Gradio encodes it as PNG),
+    # 'path' writes the encoded payload to a file Gradio can send as is.
+    # Raw bytes are not an option: gr.Image does not take them as a value
+    def __init__(self, fmt='png', quality=85, output='path', max_bytes=None, tmp_dir=None, keep_files=256):
+        fmt = fmt.lower().replace('jpg', 'jpeg')
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown map format {fmt}, expected one of {', '.join(FORMATS)}")
+        if output not in OUTPUTS:
+            raise ValueError(f"Unknown map output {output}, expected one of {', '.join(OUTPUTS)}")
+        self.fmt = fmt
+        self.quality = quality
+        self.output = output
+        self.max_bytes = max_bytes
+        self.tmp_dir = tmp_dir
+        self.files = deque()
+        self.keep_files = keep_files
+        self.base_cache = {}
+        self.base_lock = threading.Lock()
+        self.lock = threading.Lock()
+
+    def encode(self, pil):
+        start = time.perf_counter()
+        quality = self.quality
+        while True:
+            img_buf = io.BytesIO()
+            if self.fmt == 'png':
+                pil.save(img_buf, format='PNG')
+            else:
+                # no alpha channel in JPEG, and no point in sending one for a map
+                pil.convert('RGB').save(img_buf, format=FORMATS[self.fmt], quality=quality)
+            data = img_buf.getvalue()
+            # lossy formats trade quality for size until the payload fits the budget
+            if self.fmt == 'png' or self.max_bytes is None or len(data) <= self.max_bytes or quality <= 40:
+                break
+            quality -= 15
+        if enabled():
+            observe('map.encode', time.perf_counter() - start)
+        self.record(len(data))
+        return data
+
+    def record(self, size):
+        # maps_encoded and map_bytes give the average payload sent, e.g. to check a max_bytes budget
+        incr('maps_encoded')
+        incr('map_bytes', size)
+
+    def write(self, data, name=None):
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix='plonk_maps_')
+        path = os.path.join(self.tmp_dir, f"{name or uuid.uuid4().hex}.{self.fmt}")
+        with span('map.write'), open(path, 'wb') as f:
+            f.write(data)
+        if name is None:
+            # click maps are read by Gradio right away, only keep the most recent ones around
+            with self.lock:
+                self.files.append(path)
+                old = self.files.popleft() if len(self.files) > self.keep_files else None
+            if old is not None and os.path.exists(old):
+                os.remove(old)
+        return path
+
+    def __call__(self, pil):
+        if self.output == 'pil':
+            return pil
+        return self.write(self.encode(pil))
+
+    def base(self, base):
+        # The base map is the same for everyone: encode it once per setting
+        if self.output == 'pil':
+            return base.image()
+        key = (base.size, base.extent, base.dpi)
+        out = self.base_cache.get(key)
+        if out is None:
+            # read without a renderer by every new game: written once, by whichever comes first
+            with self.base_lock:
+                out = self.base_cache.get(key)
+                if out is None:
+                    if self.fmt == 'png':
+                        # the base raster was rendered as PNG in the first place
+                        data = base.png
+                        self.record(len(data))
+                    else:
+                        data = self.encode(base.image())
+                    out = self.write(data, name=f"base_{base.size[0]}x{base.size[1]}_{base.dpi}")
+                    self.base_cache[key] = out
+        return out
+
+
+class Renderer(object):
+    # Draws the maps of one request at a time, sessions borrow one from the RendererPool
+    def __init__(self, encoder, dpi=DPI):
+        self.encoder = encoder
+        self.dpi = dpi
+
+    @property
+    def base_map(self):
+        return get_base_map(dpi=self.dpi)
+
+    def base(self):
+        return self.encoder.base(self.base_map)
+
+    def click(self, click_lon, click_lat, true_lon, true_lat):
+        with span('map.draw'):
+            pil = draw_click_overlay(self.base_map, click_lon, click_lat, true_lon, true_lat)
+        return self.encoder(pil)
+
+    def summary(self, path, click_lons, click_lats, true_lons, true_lats):
+        # The recap map of a finished game, written to path in the encoder's format
+        with span('map.summary'):
+            pil = draw_summary_overlay(self.base_map, click_lons, click_lats, true_lons, true_lats)
+        data = self.encoder.encode(pil)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+class RendererPool(object):
+    # A fixed number of renderers shared by all sessions: rendering concurrency
+    # is capped to the pool size however many players are connected
+    def __init__(self, size=None, encoder=None, dpi=DPI):
+        self.size = size or os.cpu_count() or 1
+        self.encoder = encoder if encoder is not None else MapEncoder()
+        self.dpi = dpi
+        self.renderers = queue.Queue()
+        for _ in range(self.size):
+            self.renderers.put(Renderer(self.encoder, dpi))
+
+    @property
+    def base_map(self):
+        return get_base_map(dpi=self.dpi)
+
+    def base(self):
+        # The encoded base map is cached, no need to wait for a renderer to hand it out
+        return self.encoder.base(self.base_map)
+
+    @contextmanager
+    def checkout(self, timeout=None):
+        renderer = self.renderers.get(timeout=timeout)
+        try:
+            yield renderer
+        finally:
+            self.renderers.put(renderer)
@@ -0,0 +1,156 @@
+"""Game results storage: click and final records are queued and written by a background thread"""
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import traceback
+from metrics import span
+
+# none: left to the OS buffers, flush: handed to the OS after every batch, fsync: on disk after every batch
+DURABILITY = ('none', 'flush', 'fsync')
+
+
+class FileBackend(object):
+    # The original layout: results/<session>/NN.txt per click and full.txt at the end
+    def __init__(self, results_dir):
+        self.results_dir = results_dir
+
+    def write_file(self, path, text, durability):
+        with open(path, 'w') as f:
+            print(text, file=f)
+            if durability == 'fsync':
+                f.flush()
+                os.fsync(f.fileno())
+
+    def write(self, records, durability):
+        for record in records:
+            path = os.path.join(self.results_dir, record['session'])
+            os.makedirs(path, exist_ok=True)
+            if record['type'] == 'click':
+                text = f"{record['score']}, {record['distance']}, {record['lat']}, {record['lon']}, {record['time']}"
+                self.write_file(os.path.join(path, str(record['index']).zfill(2) + '.txt'), text, durability)
+            else:
+                text = f"{record['results']}" + '\n Times: ' + ', '.join(map(str, record['times']))
+                self.write_file(os.path.join(path, 'full.txt'), text, durability)
+
+    def close(self):
+        pass
+
+
+class JsonlBackend(object):
+    # One append-only log per process, one JSON record per line
+    def __init__(self, results_dir):
+        os.makedirs(results_dir, exist_ok=True)
+        self.path = os.path.join(results_dir, f"results-{os.getpid()}.jsonl")
+        self.f = open(self.path, 'a')
+
+    def write(self, records, durability):
+        self.f.write(''.join(json.dumps(record) + '\n' for record in records))
+        if durability != 'none':
+            self.f.flush()
+        if durability == 'fsync':
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class SqliteBackend(object):
+    # A local SQLite database in WAL mode, shared by all the processes of the machine
+    SYNCHRONOUS = {'none': 'OFF', 'flush': 'NORMAL', 'fsync': 'FULL'}
+
+    def __init__(self, results_dir):
+        os.makedirs(results_dir, exist_ok=True)
+        self.path = os.path.join(results_dir, 'results.db')
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS clicks (session TEXT, idx INTEGER, image_id TEXT, score REAL, distance REAL, '
+            'lat REAL, lon REAL, time REAL, created REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS finals (session TEXT, results TEXT, times TEXT, created REAL)')
+        self.db.commit()
+        self.durability = None
+
+    def write(self, records, durability):
+        if durability != self.durability:
+            self.db.execute(f'PRAGMA synchronous={self.SYNCHRONOUS[durability]}')
+            self.durability = durability
+        clicks = [(r['session'], r['index'], str(r['image_id']), r['score'], r['distance'], r['lat'], r['lon'], r['time'], r['created'])
+                  for r in records if r['type'] == 'click']
+        finals = [(r['session'], r['results'], json.dumps(r['times']), r['created']) for r in records if r['type'] == 'final']
+        with self.db:
+            self.db.executemany('INSERT INTO clicks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', clicks)
+            self.db.executemany('INSERT INTO finals VALUES (?, ?, ?, ?)', finals)
+
+    def close(self):
+        self.db.close()
+
+
+BACKENDS = {'files': FileBackend, 'jsonl': JsonlBackend, 'sqlite': SqliteBackend}
+
+
+class ResultsWriter(object):
+    # Request handlers only put records on a queue, a background thread writes them in batches
+    def __init__(self, backend, durability='flush', batch_size=256, interval=0.5):
+        if durability not in DURABILITY:
+            raise ValueError(f"Unknown durability {durability}, expected one of {', '.join(DURABILITY)}")
+        self.backend = backend
+        self.durability = durability
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='results-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def click(self, session, index, image_id, score, distance, location, time_elapsed):
+        self.queue.put({
+            'type': 'click', 'session': session, 'index': index, 'image_id': image_id,
+            'score': score, 'distance': distance, 'lat': location[0], 'lon': location[1],
+            'time': time_elapsed, 'created': time.time(),
+        })
+
+    def final(self, session, final_results, times):
+        self.queue.put({'type': 'final', 'session': session, 'results': final_results, 'times': list(times), 'created': time.time()})
+
+    def run(self):
+        while True:
+            # wait for a record, then gather what arrives within the interval into one batch
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            try:
+                if records:
+                    with span('results.write'):
+                        self.backend.write(records, self.durability)
+            except Exception:
+                traceback.print_exc()
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                return
+
+    def flush(self):
+        # Block until everything queued so far is written
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.backend.close()
+
+
+def open_results(results_dir, backend='jsonl', durability='flush'):
+    return ResultsWriter(BACKENDS[backend](results_dir), durability)
@@ -1,15 +1,21 @@
 import os
 import csv
+import json
+import random
 import argparse
 import pandas as pd
 import tkinter as tk
 from PIL import Image, ImageTk
 import cartopy.crs as ccrs
-import cartopy.feature as cfeature
-import reverse_geocoder as rg
+from geocode import search
+from admin_polygons import admin_names
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from natural_earth import add_features
 import shutil
+from itertools import repeat
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 class ImageSorter:
     def __init__(self, args, master, images, coordinates):
@@ -55,8 +61,7 @@ class ImageSorter:
         self.ax.clear()
         self.ax.set_global()
         self.ax.stock_img()
-        self.ax.add_feature(cfeature.COASTLINE)
-        self.ax.add_feature(cfeature.BORDERS, linestyle=':')
+        add_features(self.ax)
 
         # Add the location of the image as a red dot
         lon, lat = self.coordinates[self.index]
@@ -80,67 +85,128 @@ class ImageSorter:
         destination_path = os.path.join(self.select_folder, f"{self.images[self.index]}.jpg")
         shutil.copy(current_image_path, destination_path)
 
-def load_images_and_coordinates(csv_file, source_folder):
-    # Load the CSV
-    df = pd.read_csv(csv_file)
-    
-    df = df.sample(n=1000)
-
-    # Get the image filenames and their coordinates
-    image_ids = df['image_id'].tolist()
-    coordinates = df[['longitude', 'latitude']].values.tolist()
-    
-    
-
-    # Filter out images that don't exist
-    valid_images = [img_id for img_id in image_ids if os.path.exists(os.path.join(source_folder, f"{img_id}.jpg"))]
-    valid_coordinates = [coordinates[image_ids.index(img_id)] for img_id in valid_images]
-
-    return valid_images, valid_coordinates
-
-
-def create_select_csv(select_folder, original_csv, output_csv_path):
-    # Read the original CSV and create a mapping from image_id to coordinates
-    image_to_coords = {}
-    with open(original_csv, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
+def index_folder(folder, cache_file=None):
+    # Ids of the images of a folder, listed once with scandir.
+    # With a cache_file, the listing is kept on disk until the folder's mtime changes
+    mtime = os.stat(folder).st_mtime
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['folder'] == os.path.abspath(folder) and cached['mtime'] == mtime:
+            return set(cached['ids'])
+
+    with os.scandir(folder) as entries:
+        ids = {entry.name[:-4] for entry in entries if entry.name.endswith('.jpg')}
+
+    if cache_file is not None:
+        with open(cache_file, 'w') as f:
+            json.dump({'folder': os.path.abspath(folder), 'mtime': mtime, 'ids': sorted(ids)}, f)
+    return ids
+
+
+def load_images_and_coordinates(csv_file, source_folder, n=1000, index_cache=None):
+    available = index_folder(source_folder, index_cache)
+
+    # Reservoir sampling in a single pass over the CSV, only over the images that are in the folder
+    sample = []
+    seen = 0
+    with open(csv_file, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        id_col, lon_col, lat_col = header.index('image_id'), header.index('longitude'), header.index('latitude')
         for row in reader:
-            image_to_coords[row['image_id']] = (float(row['latitude']), float(row['longitude']))  # reverse_geocoder expects (lat, lon)
+            if row[id_col] not in available:
+                continue
+            seen += 1
+            if len(sample) < n:
+                sample.append(row)
+            else:
+                j = random.randrange(seen)
+                if j < n:
+                    sample[j] = row
+    random.shuffle(sample)
 
+    # Get the image filenames and their coordinates
+    image_ids = [row[id_col] for row in sample]
+    coordinates = [[float(row[lon_col]), float(row[lat_col])] for row in sample]
+
+    return image_ids, coordinates
+
+
+def annotate_rows(rows, admin='geocoder'):
+    # rows: (image_id, latitude, longitude) tuples, reverse geocoded in a single query.
+    # With admin='polygons', region and country are those of the polygons holding the location
+    results = search([(lat, lon) for _, lat, lon in rows])
+    annotated = [{
+        'image_id': image_id,
+        'longitude': lon,
+        'latitude': lat,
+        'city': result['name'],
+        'area': result['admin2'],
+        'region': result['admin1'],
+        'country': result['cc']
+    } for (image_id, lat, lon), result in zip(rows, results)]
+    if admin == 'polygons':
+        names = admin_names([lon for _, _, lon in rows], [lat for _, lat, _ in rows])
+        for row, region, country in zip(annotated, names['region'], names['country']):
+            # NaN (no polygon, e.g. on the coast) is written as an empty cell, as missing values are
+            row['region'] = region if isinstance(region, str) else ''
+            row['country'] = country if isinstance(country, str) else ''
+    return annotated
+
+
+def selected_chunks(original_csv, selected_ids, chunksize):
+    # Stream the original CSV and only keep the rows of selected images
+    seen = set()
+    reader = pd.read_csv(original_csv, usecols=['image_id', 'latitude', 'longitude'], dtype={'image_id': str},
+                         float_precision='round_trip', chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[chunk['image_id'].isin(selected_ids)]
+        rows = []
+        for image_id, lat, lon in zip(chunk['image_id'], chunk['latitude'], chunk['longitude']):
+            if image_id not in seen:
+                seen.add(image_id)
+                rows.append((image_id, lat, lon))
+        if rows:
+            yield rows
+
+
+def create_select_csv(select_folder, original_csv, output_csv_path, chunksize=100000, workers=0, admin='geocoder'):
     # List the files in the select_folder
-    selected_files = [f for f in os.listdir(select_folder) if os.path.isfile(os.path.join(select_folder, f))]
+    selected_ids = {os.path.splitext(entry.name)[0] for entry in os.scandir(select_folder) if entry.is_file()}
 
     # Write the select.csv file
     with open(output_csv_path, 'w', newline='') as csvfile:
         fieldnames = ['image_id', 'longitude', 'latitude', 'city', 'area', 'region', 'country']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
         writer.writeheader()
-        
-        for file in selected_files:
-            # Extract image_id from filename
-            image_id = os.path.splitext(file)[0]
-            if image_id in image_to_coords:
-                # Perform reverse geocoding
-                coordinates = image_to_coords[image_id]
-                results = rg.search(coordinates)  # Returns a list of dictionaries
-                result = results[0]  # Get the first result
-
-                # Write to CSV if image_id exists in the mapping
-                writer.writerow({
-                    'image_id': image_id,
-                    'longitude': coordinates[1],
-                    'latitude': coordinates[0],
-                    'city': result['name'],
-                    'area': result['admin2'],
-                    'region': result['admin1'],
-                    'country': result['cc']
-                })
+
+        chunks = selected_chunks(original_csv, selected_ids, chunksize)
+        if workers > 0:
+            # chunks are annotated in parallel and written back in order. executor.map would read the
+            # whole CSV up front: only a window of 2 chunks per worker is in flight, refilled as they are written
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                window = deque()
+                for rows in chunks:
+                    window.append(executor.submit(annotate_rows, rows, admin))
+                    if len(window) >= 2 * workers:
+                        writer.writerows(window.popleft().result())
+                while window:
+                    writer.writerows(window.popleft().result())
+        else:
+            for rows in map(annotate_rows, chunks, repeat(admin)):
+                writer.writerows(rows)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Image Viewer with Map')
     parser.add_argument('--source_folder', type=str, required=False, help='Folder with images', default='/home/ign.fr/llandrieu/Documents/code/geoscrapping/images/test')
     parser.add_argument('--select_folder', type=str, required=False, help='Folder to copy selected images into', default='/home/ign.fr/llandrieu/Documents/code/geoscrapping/images/select')
     parser.add_argument('--csv_file', type=str, required=False, help='CSV file with image ids and coordinates', default='/home/ign.fr/llandrieu/Documents/code/geoscrapping/processed/test.csv')
+    parser.add_argument('--sample', type=int, required=False, help='Number of images to browse', default=1000)
+    parser.add_argument('--index_cache', type=str, required=False, help='File where the listing of the source folder is cached', default=None)
+    parser.add_argument('--chunksize', type=int, required=False, help='Rows of the CSV annotated at a time', default=100000)
+    parser.add_argument('--workers', type=int, required=False, help='Processes used to annotate the chunks (0: none)', default=0)
+    parser.add_argument('--admin', type=str, required=False, help='Source of the region and country columns: geocoder or polygons (see admin_polygons.py)', default='geocoder')
 
     args = parser.parse_args()
 
@@ -150,12 +216,13 @@ if __name__ == "__main__":
         
     if True:
 
-        images, coordinates = load_images_and_coordinates(args.csv_file, args.source_folder)
+        images, coordinates = load_images_and_coordinates(args.csv_file, args.source_folder, args.sample, args.index_cache)
 
         root = tk.Tk()
         app = ImageSorter(args, root, images, coordinates)
         root.mainloop()
     
     else:
-        create_select_csv(args.select_folder, args.csv_file, '/home/ign.fr/llandrieu/Documents/code/geoscrapping/processed/select.csv')
+        create_select_csv(args.select_folder, args.csv_file, '/home/ign.fr/llandrieu/Documents/code/geoscrapping/processed/select.csv',
+                          args.chunksize, args.workers, args.admin)
     
\ No newline at end of file
@@ -0,0 +1,252 @@
+"""Game sessions kept outside the worker processes, so any of them can serve any player,
+and idle ones moved out of memory"""
+import os
+import sys
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, Counter
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS sessions (session TEXT PRIMARY KEY, state BLOB, updated REAL)'
+
+
+class SessionStore(object):
+    # One SQLite file in WAL mode shared by the processes of the machine:
+    # readers never wait for the writer, and a session written by a worker is seen by all the others.
+    # States are opaque bytes (see Engine.to_state), each thread of a process gets its own connection
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self.connect()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(SCHEMA)
+        db.commit()
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # the sessions are small and rewritten every round, losing the last one on a power cut is fine
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def save(self, session, state):
+        db = self.connect()
+        with db:
+            db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', (session, state, time.time()))
+
+    def load(self, session):
+        # None for an unknown session
+        row = self.connect().execute('SELECT state FROM sessions WHERE session = ?', (session,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete(self, session):
+        db = self.connect()
+        with db:
+            db.execute('DELETE FROM sessions WHERE session = ?', (session,))
+
+    def expire(self, seconds):
+        # deletes the sessions not played for that long, returns their number
+        db = self.connect()
+        with db:
+            return db.execute('DELETE FROM sessions WHERE updated < ?', (time.time() - seconds,)).rowcount
+
+    def stats(self):
+        # number of sessions and bytes of state stored
+        count, size = self.connect().execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(state)), 0) FROM sessions').fetchone()
+        return {'sessions': count, 'bytes': size}
+
+
+def approx_size(value):
+    # Bytes held by a session's own objects: containers are followed, anything else is counted flat.
+    # Containers are copied first, the session may be playing while it is measured
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in list(value.items()))
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(v) for v in list(value))
+    elif hasattr(value, '__dict__'):
+        size += approx_size(vars(value))
+    return size
+
+
+class SessionManager(object):
+    # The live sessions of a process, least recently used first. A session idle for ttl seconds,
+    # or the oldest ones beyond max_sessions, are written to the store and dropped from memory;
+    # use() brings them back when the player returns. Spilled sessions are deleted after keep seconds.
+    # engine_state(engine) -> bytes and load_engine(session, bytes) -> engine convert them,
+    # forget(session), if given, is called when a session leaves the memory of the process.
+    # The lock only guards the dicts: the store is read and written outside of it, so moving one session
+    # in or out never holds up the others, and a session being moved is waited for in moving.
+    # Each session in use also has its own lock, so the requests of one player run one at a time.
+    def __init__(self, store, engine_state, load_engine, ttl=600., max_sessions=1000, keep=7 * 24 * 3600., interval=10.,
+                 forget=None):
+        self.store = store
+        self.engine_state = engine_state
+        self.load_engine = load_engine
+        self.forget = forget
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.keep = keep
+        self.interval = interval
+        self.sessions = OrderedDict()
+        self.last_used = {}
+        self.in_use = Counter()
+        # sessions added and not used yet: their engine is still being set up, see add
+        self.added = set()
+        self.moving = {}
+        self.session_locks = {}
+        self.lock = threading.Lock()
+        self.last_sweep = 0.
+        self.evicted = 0
+        self.resumed = 0
+
+    def add(self, session, engine):
+        # counted in use until the end of its first use(), so it is not evicted half set up
+        with self.lock:
+            self.sessions[session] = engine
+            self.last_used[session] = time.monotonic()
+            self.hold(session)
+            self.added.add(session)
+        self.sweep()
+
+    def hold(self, session):
+        # under self.lock: the session's own lock lives as long as someone uses or waits for the session
+        self.in_use[session] += 1
+        if session not in self.session_locks:
+            self.session_locks[session] = threading.Lock()
+
+    def acquire(self, session):
+        # The engine in memory, marked in use, or None after the caller was made the one loading it
+        while True:
+            with self.lock:
+                engine = self.sessions.get(session)
+                if engine is not None:
+                    self.sessions.move_to_end(session)
+                    self.last_used[session] = time.monotonic()
+                    self.hold(session)
+                    return engine
+                moved = self.moving.get(session)
+                if moved is None:
+                    self.moving[session] = threading.Event()
+                    return None
+            # being written to the store or read back by another thread
+            moved.wait()
+
+    def resume(self, session):
+        engine = None
+        try:
+            state = self.store.load(session)
+            if state is not None:
+                engine = self.load_engine(session, state)
+                self.store.delete(session)
+        finally:
+            with self.lock:
+                if engine is not None:
+                    self.sessions[session] = engine
+                    self.last_used[session] = time.monotonic()
+                    self.hold(session)
+                    self.resumed += 1
+                self.moving.pop(session).set()
+        return engine
+
+    @contextmanager
+    def use(self, session, exclusive=True):
+        # The engine of a session (None when it is unknown or expired), never evicted while in use.
+        # exclusive waits for the other exclusive users of the session: only reads may share it
+        engine = self.acquire(session)
+        if engine is None:
+            engine = self.resume(session)
+        session_lock = None
+        if engine is not None and exclusive:
+            with self.lock:
+                session_lock = self.session_locks[session]
+            session_lock.acquire()
+        try:
+            yield engine
+        finally:
+            if session_lock is not None:
+                session_lock.release()
+            if engine is not None:
+                with self.lock:
+                    self.in_use[session] -= 1
+                    if session in self.added:
+                        self.added.discard(session)
+                        self.in_use[session] -= 1
+                    if not self.in_use[session]:
+                        del self.in_use[session]
+                        del self.session_locks[session]
+                    # unless the session was removed meanwhile (a finished game)
+                    if session in self.sessions:
+                        self.last_used[session] = time.monotonic()
+            self.sweep()
+
+    def remove(self, session):
+        # a finished game is neither kept nor resumable
+        with self.lock:
+            self.sessions.pop(session, None)
+            self.last_used.pop(session, None)
+            if session in self.added:
+                # removed before its first use: add's hold goes too
+                self.added.discard(session)
+                self.in_use[session] -= 1
+                if not self.in_use[session]:
+                    del self.in_use[session]
+                    del self.session_locks[session]
+        self.store.delete(session)
+        if self.forget is not None:
+            self.forget(session)
+
+    def evict(self, session, engine):
+        # the engine was already taken out of the dicts, under the lock
+        try:
+            self.store.save(session, self.engine_state(engine))
+        finally:
+            with self.lock:
+                self.evicted += 1
+                self.moving.pop(session).set()
+        if self.forget is not None:
+            self.forget(session)
+
+    def sweep(self, force=False):
+        now = time.monotonic()
+        evicted = []
+        with self.lock:
+            over = len(self.sessions) - self.max_sessions
+            if not force and over <= 0 and now - self.last_sweep < self.interval:
+                return
+            self.last_sweep = now
+            for session in list(self.sessions):
+                if session in self.in_use:
+                    continue
+                if over > 0:
+                    over -= 1
+                elif now - self.last_used[session] < self.ttl:
+                    # least recently used first: the others are even more recent
+                    break
+                evicted.append((session, self.sessions.pop(session)))
+                del self.last_used[session]
+                self.moving[session] = threading.Event()
+        for session, engine in evicted:
+            self.evict(session, engine)
+        self.store.expire(self.keep)
+
+    def engine_bytes(self, engine):
+        # slots not set yet (a game being started) hold nothing
+        return sys.getsizeof(engine) + sum(approx_size(getattr(engine, name)) for name in engine.OWN_SLOTS
+                                           if hasattr(engine, name))
+
+    def stats(self):
+        # the engines are measured outside the lock, requests go on meanwhile
+        with self.lock:
+            engines = list(self.sessions.values())
+            evicted, resumed = self.evicted, self.resumed
+        sizes = [self.engine_bytes(engine) for engine in engines]
+        stats = {'live': len(sizes), 'live_bytes': sum(sizes), 'max_session_bytes': max(sizes, default=0),
+                 'evicted': evicted, 'resumed': resumed}
+        stored = self.store.stats()
+        stats['spilled'], stats['spilled_bytes'] = stored['sessions'], stored['bytes']
+        return stats